@@ -0,0 +1,184 @@
+# coding=utf-8
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from json import dump
+from os import times
+from sys import platform
+from threading import Lock
+from timeit import default_timer
+
+try:
+    from resource import RUSAGE_CHILDREN
+    from resource import RUSAGE_SELF
+    from resource import getrusage
+except ImportError:
+    getrusage = None
+
+# upper bounds of latency histogram buckets in seconds
+histogram_bounds = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def cpu_time():
+    # includes finished worker processes
+    t = times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def peak_memory():
+    # peak resident set size in megabytes of the process and of its
+    # finished worker processes, None where it is not known
+    if getrusage is None:
+        return None
+
+    unit = 1024 * 1024 if platform == 'darwin' else 1024
+    return round(max(getrusage(RUSAGE_SELF).ru_maxrss,
+                     getrusage(RUSAGE_CHILDREN).ru_maxrss) / float(unit), 1)
+
+
+def bucket_name(index):
+    if index < len(histogram_bounds):
+        return '<={}'.format(histogram_bounds[index])
+
+    return '>{}'.format(histogram_bounds[-1])
+
+
+class Instrumentation(object):
+    # Stage timers, counters and latency histograms of a run. Worker
+    # processes of map_parallel collect their own metrics, which are
+    # sent back along with the results and merged here.
+    def __init__(self):
+        self._lock = Lock()
+        self._stages = OrderedDict()
+        self._counters = {}
+        self._histograms = {}
+
+    def reset(self):
+        with self._lock:
+            self._stages = OrderedDict()
+            self._counters = {}
+            self._histograms = {}
+
+    @contextmanager
+    def stage(self, name, items=0):
+        # items processed by the stage give its throughput
+        start = default_timer()
+        start_cpu = cpu_time()
+
+        try:
+            yield
+        finally:
+            self._add_stage(name, [1,
+                                   default_timer() - start,
+                                   cpu_time() - start_cpu,
+                                   items])
+
+    @contextmanager
+    def timer(self, name):
+        start = default_timer()
+
+        try:
+            yield
+        finally:
+            self.observe(name, default_timer() - start)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self._histograms.get(name)
+
+            if histogram is None:
+                # count, sum, max, buckets
+                histogram = self._histograms[name] = \
+                    [0, 0.0, 0.0, [0] * (len(histogram_bounds) + 1)]
+
+            histogram[0] += 1
+            histogram[1] += seconds
+            histogram[2] = max(histogram[2], seconds)
+            histogram[3][bisect_left(histogram_bounds, seconds)] += 1
+
+    def _add_stage(self, name, record):
+        with self._lock:
+            stage = self._stages.get(name)
+
+            if stage is None:
+                self._stages[name] = record
+            else:
+                self._stages[name] = [a + b for a, b in zip(stage, record)]
+
+    def collect(self):
+        # takes metrics recorded since the last call
+        with self._lock:
+            metrics = self._stages, self._counters, self._histograms
+            self._stages = OrderedDict()
+            self._counters = {}
+            self._histograms = {}
+
+        return metrics
+
+    def merge(self, metrics):
+        stages, counters, histograms = metrics
+
+        for name, record in stages.items():
+            self._add_stage(name, record)
+
+        for name, value in counters.items():
+            self.count(name, value)
+
+        with self._lock:
+            for name, (count, total, longest, buckets) \
+                    in histograms.items():
+                histogram = self._histograms.setdefault(
+                    name, [0, 0.0, 0.0, [0] * len(buckets)])
+                histogram[0] += count
+                histogram[1] += total
+                histogram[2] = max(histogram[2], longest)
+                histogram[3] = [a + b for a, b
+                                in zip(histogram[3], buckets)]
+
+    def report(self):
+        with self._lock:
+            stages = OrderedDict()
+
+            for name, (calls, wall, cpu, items) in self._stages.items():
+                stages[name] = {
+                    'calls': calls,
+                    'wall_seconds': wall,
+                    'cpu_seconds': cpu
+                }
+
+                if items:
+                    stages[name]['items'] = items
+                    stages[name]['items_per_second'] = \
+                        items / max(wall, 1e-9)
+
+            histograms = OrderedDict()
+
+            for name, (count, total, longest, buckets) \
+                    in sorted(self._histograms.items()):
+                histograms[name] = {
+                    'count': count,
+                    'mean_seconds': total / count,
+                    'max_seconds': longest,
+                    'buckets': OrderedDict((bucket_name(i), n)
+                                           for i, n in enumerate(buckets)
+                                           if n)
+                }
+
+            counters = OrderedDict(sorted(self._counters.items()))
+
+        return OrderedDict([('stages', stages),
+                            ('counters', counters),
+                            ('histograms', histograms),
+                            ('peak_memory_mb', peak_memory())])
+
+    def write(self, file):
+        with open(file, 'w') as f:
+            dump(self.report(), f, indent=2)
+
+
+instrumentation = Instrumentation()
@@ -1,32 +1,138 @@
 # coding=utf-8
+from atexit import register
 from logging import DEBUG
+from logging import Filter
 from logging import Formatter
 from logging import INFO
 from logging import StreamHandler
+from logging import getLevelName
 from logging import getLogger
+from logging.handlers import QueueHandler
+from logging.handlers import QueueListener
 from logging.handlers import RotatingFileHandler
+from multiprocessing import Queue
 from os import makedirs
 from os.path import join
 
+supported_levels = ['debug', 'info', 'warning', 'error']
+
 
 class LoggerUtils:
+    # Loggers only put records into a queue, a listener thread
+    # formats them and writes them to the console and to the log
+    # file of every logger, so hot loops never wait for the disk.
+    # Pool workers put their records into the queue of the main
+    # process, so its listener is the only writer of the log files.
+    _queue = Queue()
+    _listener = None
+    _loggers = []
+    _level = DEBUG
+    _console = None
+    _files = ()
+    _worker = False
+
     @staticmethod
     def get_logger(log_name):
-        makedirs('logs', exist_ok=True)
         logger = getLogger(log_name)
-        logger.setLevel(DEBUG)
+
+        # modules importing each other get the configured logger
+        if logger.handlers:
+            return logger
+
+        logger.setLevel(LoggerUtils._level)
+        logger.addHandler(QueueHandler(LoggerUtils._queue))
+        LoggerUtils._loggers.append(logger)
+
+        if LoggerUtils._worker:
+            return logger
+
+        makedirs('logs', exist_ok=True)
         name = join('logs', log_name + '.log')
         fh = RotatingFileHandler(filename=name,
                                  maxBytes=8 * 1024 * 1024,
                                  backupCount=4, encoding='utf-8',
-                                 delay=0)
+                                 delay=True)
         fh.setLevel(DEBUG)
-        ch = StreamHandler()
-        ch.setLevel(INFO)
-        formatter = Formatter(
-            '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        fh.setFormatter(formatter)
-        ch.setFormatter(formatter)
-        logger.addHandler(fh)
-        logger.addHandler(ch)
+        fh.addFilter(Filter(log_name))
+        fh.setFormatter(LoggerUtils._formatter())
+        LoggerUtils._files += (fh,)
+        LoggerUtils._start()
         return logger
+
+    @staticmethod
+    def add_log_level_argument(parser):
+        parser.add_argument('-l', '--log_level',
+                            dest='log_level',
+                            metavar='LEVEL',
+                            choices=supported_levels,
+                            default='debug',
+                            required=False,
+                            help='Lowest level of the logged messages, '
+                                 'one of {}, debug by default. Debug '
+                                 'messages are written to the log files '
+                                 'only, info skips these per file and per '
+                                 'slice messages'
+                            .format(supported_levels))
+
+    @staticmethod
+    def set_level(level):
+        # level name like 'info', records below it are not even
+        # created, the console never shows debug records
+        LoggerUtils._level = getLevelName(level.upper())
+
+        for logger in LoggerUtils._loggers:
+            logger.setLevel(LoggerUtils._level)
+
+    @staticmethod
+    def queue():
+        return LoggerUtils._queue
+
+    @staticmethod
+    def start_worker(queue):
+        # queue is the one of the main process. A forked worker shares
+        # it and has a copy of the listener without its thread, a
+        # spawned one has started a listener on a queue of its own
+        # while its modules were imported.
+        if LoggerUtils._listener is not None and \
+                LoggerUtils._queue is not queue:
+            LoggerUtils._listener.stop()
+
+        LoggerUtils._queue = queue
+        LoggerUtils._listener = None
+        LoggerUtils._files = ()
+        LoggerUtils._worker = True
+
+        for logger in LoggerUtils._loggers:
+            for handler in logger.handlers:
+                handler.queue = queue
+
+    @staticmethod
+    def stop():
+        if LoggerUtils._listener is not None:
+            LoggerUtils._listener.stop()
+            LoggerUtils._listener = None
+
+    @staticmethod
+    def _formatter():
+        return Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    @staticmethod
+    def _start():
+        if LoggerUtils._console is None:
+            LoggerUtils._console = StreamHandler()
+            LoggerUtils._console.setLevel(INFO)
+            LoggerUtils._console.setFormatter(LoggerUtils._formatter())
+
+        handlers = (LoggerUtils._console,) + LoggerUtils._files
+
+        if LoggerUtils._listener is None:
+            LoggerUtils._listener = QueueListener(
+                LoggerUtils._queue, *handlers, respect_handler_level=True)
+            LoggerUtils._listener.start()
+        else:
+            LoggerUtils._listener.handlers = handlers
+
+
+# records still in the queue are written before the exit
+register(LoggerUtils.stop)
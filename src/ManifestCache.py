@@ -0,0 +1,103 @@
+# coding=utf-8
+from os.path import basename
+from os.path import isfile
+
+from Instrumentation import instrumentation
+from Utils import CacheError
+from Utils import create_cache
+from Utils import load_cache
+from Utils import source_fingerprint
+from Utils import stat_signature
+
+manifest_version = 2
+
+
+class ManifestCache(object):
+    def __init__(self, cache_file, log, version=1):
+        self._cache_file = cache_file
+        self._log = log
+        # version of the cached entries format of the loader
+        self._fingerprint = source_fingerprint(manifest_version, version)
+        # file -> (signature, entry, failed)
+        self._records = {}
+        self._signatures = {}
+        self._modified = False
+
+    def load(self):
+        if not isfile(self._cache_file):
+            return
+
+        try:
+            cache = load_cache(self._cache_file, self._fingerprint)
+        except CacheError as e:
+            self._log.warn('{}, it will be rebuilt'.format(e))
+            return
+        except Exception:
+            self._log.warn('Can\'t load cache {}, it will be rebuilt'
+                           .format(self._cache_file), exc_info=True)
+            return
+
+        self._records = cache['records']
+        self._log.info('Found cache file with {} files: {}'
+                       .format(len(self._records), self._cache_file))
+
+    def refresh(self, files):
+        # Consumes (file, stat) pairs and yields files which are new or
+        # changed since the cache has been created, so parsing can start
+        # while the files are still being listed. Deleted files are
+        # forgotten once the stream of files is over.
+        changed = 0
+        self._signatures = {}
+
+        for file, stat_result in files:
+            signature = stat_signature(stat_result)
+            self._signatures[file] = signature
+            record = self._records.get(file)
+
+            if record is None or record[0] != signature:
+                changed += 1
+                yield file
+
+        name = basename(self._cache_file)
+        instrumentation.count('{}.hits'.format(name),
+                              len(self._signatures) - changed)
+        instrumentation.count('{}.misses'.format(name), changed)
+
+        # the stream may be consumed in another thread while changed
+        # files are being stored, so records are iterated over a copy
+        deleted = [f for f in list(self._records)
+                   if f not in self._signatures]
+
+        for file in deleted:
+            del self._records[file]
+
+        if deleted:
+            self._modified = True
+
+        self._log.info('{} new or changed, {} deleted, {} unchanged '
+                       'files'.format(changed, len(deleted),
+                                      len(self._signatures) - changed))
+
+    def store(self, file, entry, failed=False):
+        self._records[file] = (self._signatures[file], entry, failed)
+        self._modified = True
+
+    def entries(self):
+        return [(f, self._records[f][1])
+                for f in sorted(self._records)
+                if self._records[f][1] is not None]
+
+    def error_files(self):
+        return [f for f in sorted(self._records)
+                if self._records[f][2]]
+
+    def save(self):
+        if not self._modified:
+            return
+
+        self._log.info('Updating cache: {}'.format(self._cache_file))
+        create_cache(self._cache_file,
+                     {'records': self._records},
+                     self._log,
+                     self._fingerprint)
+        self._modified = False
@@ -1,38 +1,344 @@
 # coding=utf-8
-from os import walk
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool
+from os import fsync
+from os import getpid
+from os import makedirs
+from os import remove
+from os import rename
+from os import replace
+from os import scandir
+from os import stat
+from os.path import exists
+from os.path import getsize
 from os.path import join
-from pickle import dump
+from pickle import HIGHEST_PROTOCOL
+from pickle import dumps
 from pickle import load
+from pickle import loads
+from queue import Queue
+from shutil import rmtree
+from struct import Struct
+from zlib import crc32
 
-from PIL.Image import fromarray, new, BILINEAR
 from numpy import asarray
+from numpy import lexsort
+from numpy import ones
+from numpy import load as load_array
+from numpy import save
 
+from Instrumentation import instrumentation
+from LoggerUtils import LoggerUtils
 
-def list_files(directory, ext=''):
-    return [f for l
-            in [[join(dir_name, f)
-                 for f in file_list
-                 if f.lower().endswith(ext)]
-                for dir_name, _, file_list
-                in walk(directory)]
-            for f in l]
 
+scan_threads = 8
+
+
+def scan_directory(directory, ext=''):
+    # returns matching files with their stat results and
+    # subdirectories, unreadable entries are skipped like os.walk does
+    files = []
+    directories = []
 
-def create_cache(file, obj, log):
     try:
-        with open(file, mode='wb') as f:
-            dump(obj, f)
+        for entry in scandir(directory):
+            try:
+                if entry.is_dir():
+                    # symbolic links to directories are not followed
+                    if not entry.is_symlink():
+                        directories.append(entry.path)
+                elif entry.name.lower().endswith(ext):
+                    files.append((entry.path, entry.stat()))
+            except OSError:
+                pass
+    except OSError:
+        pass
+
+    return files, directories
+
+
+def scan_files(directory, ext='', threads=scan_threads):
+    # Directories are listed and files are stat'ed in parallel threads,
+    # which pays off on network storage where every call waits for
+    # a round trip. (path, stat) pairs are yielded as soon as their
+    # directory has been listed, in no particular order.
+    listed = Queue()
+
+    with ThreadPoolExecutor(threads) as executor:
+        executor.submit(scan_directory, directory, ext) \
+            .add_done_callback(listed.put)
+        pending = 1
+
+        while pending:
+            files, directories = listed.get().result()
+            pending += len(directories) - 1
+
+            for subdirectory in directories:
+                executor.submit(scan_directory, subdirectory, ext) \
+                    .add_done_callback(listed.put)
+
+            yield from files
+
+
+def chunks(items, size):
+    # items may be a stream which is consumed chunk by chunk
+    items = iter(items)
+    chunk = list(islice(items, size))
+
+    while chunk:
+        yield chunk
+        chunk = list(islice(items, size))
+
+
+def _start_worker(log_queue):
+    # forked workers start with a copy of the parent metrics,
+    # log records are put into the queue of the parent
+    instrumentation.reset()
+    LoggerUtils.start_worker(log_queue)
+
+
+def _call_collecting(function, item):
+    # metrics of the worker are sent back along with the result
+    return function(item), instrumentation.collect()
+
+
+def map_parallel(function, iterable, jobs=1, chunk_size=1):
+    # results are yielded in the order of the source items,
+    # so callers can merge them deterministically
+    if jobs > 1:
+        with Pool(processes=jobs, initializer=_start_worker,
+                  initargs=(LoggerUtils.queue(),)) as pool:
+            for result, metrics in pool.imap(partial(_call_collecting,
+                                                     function),
+                                             iterable, chunk_size):
+                instrumentation.merge(metrics)
+                yield result
+
+            # workers which exit on their own send all their queued
+            # log records before the pool is terminated
+            pool.close()
+            pool.join()
+    else:
+        yield from map(function, iterable)
+
+
+# Cache file layout: header (magic, format version, checksum and
+# length of the body), then the body: source fingerprint, number of
+# out-of-band buffers, lengths of the pickle and of the buffers,
+# the pickle itself and the buffers. The checksum covers the body.
+cache_magic = b'IFMOCACHE'
+cache_format_version = 1
+cache_header = Struct('<9sIIQ')
+cache_count = Struct('<I')
+cache_length = Struct('<Q')
+
+
+class CacheError(ValueError):
+    pass
+
+
+def stat_signature(stat_result):
+    return stat_result.st_size, stat_result.st_mtime_ns
+
+
+def file_signature(file):
+    return stat_signature(stat(file))
+
+
+def pickle_out_of_band(obj):
+    # since pickle protocol 5 contiguous numpy arrays are not copied
+    # into the pickle but are written as separate buffers
+    buffers = []
+
+    if HIGHEST_PROTOCOL >= 5:
+        data = dumps(obj, HIGHEST_PROTOCOL,
+                     buffer_callback=buffers.append)
+    else:
+        data = dumps(obj, HIGHEST_PROTOCOL)
+
+    return data, [b.raw() for b in buffers]
+
+
+def create_cache(file, obj, log, fingerprint=''):
+    # the cache is written to a temporary file which replaces the old
+    # cache at once, so a crash never leaves a truncated cache
+    temp_file = '{}.{}.tmp'.format(file, getpid())
+
+    try:
+        data, buffers = pickle_out_of_band(obj)
+        fingerprint = fingerprint.encode('utf-8')
+        body = [cache_count.pack(len(fingerprint)),
+                fingerprint,
+                cache_count.pack(len(buffers))] + \
+            [cache_length.pack(len(b)) for b in [data] + buffers] + \
+            [data] + buffers
+        checksum = 0
+
+        for part in body:
+            checksum = crc32(part, checksum)
+
+        with open(temp_file, mode='wb') as f:
+            f.write(cache_header.pack(cache_magic,
+                                      cache_format_version,
+                                      checksum,
+                                      sum([len(p) for p in body])))
+            for part in body:
+                f.write(part)
+            f.flush()
+            fsync(f.fileno())
+
+        replace(temp_file, file)
     except IOError:
         log.error('Can\'t create cache at {}'
                   .format(file), exc_info=True)
 
+        if exists(temp_file):
+            remove(temp_file)
+
+
+def check_cache_header(file, magic, version):
+    if magic != cache_magic:
+        raise CacheError('{} is not a cache file'.format(file))
+    if version != cache_format_version:
+        raise CacheError('Cache {} has an outdated format {}'
+                         .format(file, version))
+
 
-def load_cache(file):
+def cache_fingerprint(file):
+    # fingerprint of the source of a cache, the body is not read
+    with open(file, 'rb') as f:
+        header = f.read(cache_header.size + cache_count.size)
+
+        if len(header) < cache_header.size + cache_count.size:
+            raise CacheError('Cache {} is truncated'.format(file))
+
+        magic, version, _, _ = cache_header.unpack_from(header)
+        check_cache_header(file, magic, version)
+        size, = cache_count.unpack_from(header, cache_header.size)
+        fingerprint = f.read(size)
+
+    if len(fingerprint) != size:
+        raise CacheError('Cache {} is truncated'.format(file))
+
+    return fingerprint.decode('utf-8')
+
+
+def load_cache(file, fingerprint=None):
+    # raises CacheError if the file is not a cache of the current
+    # format, is damaged or has been built from another source
+    data = bytearray(getsize(file))
+
+    with open(file, 'rb') as f:
+        f.readinto(data)
+
+    view = memoryview(data)
+
+    if len(data) < cache_header.size:
+        raise CacheError('Cache {} is truncated'.format(file))
+
+    magic, version, checksum, length = cache_header.unpack_from(data)
+    check_cache_header(file, magic, version)
+
+    if len(data) - cache_header.size != length:
+        raise CacheError('Cache {} is truncated'.format(file))
+    if crc32(view[cache_header.size:]) != checksum:
+        raise CacheError('Cache {} is damaged'.format(file))
+
+    position = cache_header.size
+    size, = cache_count.unpack_from(data, position)
+    position += cache_count.size
+    cache_fingerprint = bytes(view[position:position + size]) \
+        .decode('utf-8')
+    position += size
+
+    if fingerprint is not None and fingerprint != cache_fingerprint:
+        raise CacheError('Cache {} has been built from another source'
+                         .format(file))
+
+    count, = cache_count.unpack_from(data, position)
+    position += cache_count.size
+    lengths = []
+
+    for _ in range(count + 1):
+        lengths.append(cache_length.unpack_from(data, position)[0])
+        position += cache_length.size
+
+    parts = []
+
+    for part_length in lengths:
+        parts.append(view[position:position + part_length])
+        position += part_length
+
+    # buffers are views of the data read, so arrays are not copied
+    if HIGHEST_PROTOCOL >= 5:
+        return loads(parts[0], buffers=parts[1:])
+    else:
+        return loads(bytes(parts[0]))
+
+
+def load_pickle(file):
+    # caches written before the cache header was introduced
     with open(file, 'rb') as f:
         return load(f)
 
 
+def source_fingerprint(*parts):
+    return repr(parts)
+
+
+def new_directory(path):
+    if exists(path):
+        rmtree(path)
+
+    makedirs(path)
+
+
+def replace_directory(source, target):
+    # directories are written aside and moved in place at once,
+    # so an interrupted write never leaves a broken one
+    if exists(target):
+        rmtree(target)
+
+    rename(source, target)
+
+
+def encode_strings(values):
+    return asarray([v.encode('utf-8') for v in values], dtype='S')
+
+
+def table_file(directory, table, column):
+    return join(directory, '{}.{}.npy'.format(table, column))
+
+
+def save_table(directory, table, columns):
+    # a table is kept as a set of column files, each of them
+    # can be memory mapped separately
+    for column, values in columns.items():
+        save(table_file(directory, table, column), values)
+
+
+def load_table(directory, table, columns):
+    return dict((column, load_array(table_file(directory, table, column),
+                                    mmap_mode='r'))
+                for column in columns)
+
+
+def group_maxima(groups, values):
+    # rows holding the maximum value of every group, of equal
+    # values the last one is taken
+    if not len(groups):
+        return asarray([], dtype='int64')
+
+    order = lexsort((values, groups))
+    group_end = ones(len(order), dtype=bool)
+    group_end[:-1] = groups[order[1:]] != groups[order[:-1]]
+    return order[group_end]
+
+
 def scale_image(im_arr, size):
+    from PIL.Image import fromarray, new, BILINEAR
     im = fromarray(im_arr)
 
     if im.width < im.height:
@@ -0,0 +1,109 @@
+# coding=utf-8
+import logging
+from argparse import ArgumentParser
+from importlib import reload
+
+from LoggerUtils import LoggerUtils
+from benchmark import ExtractionBenchmark
+from benchmark import ImportBenchmark
+from benchmark import RasterizerBenchmark
+from benchmark.ExtractionBenchmark import default_tolerance
+
+reload(logging)
+
+supported_benchmarks = {
+    'extraction': ExtractionBenchmark.run,
+    'imports': ImportBenchmark.run,
+    'rasterizer': RasterizerBenchmark.run
+}
+
+
+def main():
+    parser = ArgumentParser(
+        description='Runs performance benchmarks')
+    parser.add_argument('-b', '--benchmark',
+                        dest='benchmark',
+                        metavar='BENCHMARK',
+                        required=True,
+                        help='Benchmark to run. '
+                             'Supported benchmarks: {}'
+                        .format(sorted(supported_benchmarks.keys())))
+    parser.add_argument('-n', '--number',
+                        dest='number',
+                        metavar='NUMBER',
+                        type=int,
+                        default=None,
+                        required=False,
+                        help='Number of samples to generate: random '
+                             'contours for the rasterizer benchmark '
+                             '({} by default), synthetic patients for '
+                             'the extraction benchmark ({} by default), '
+                             'runs of every command line for the imports '
+                             'benchmark ({} by default)'
+                        .format(RasterizerBenchmark.default_contours,
+                                ExtractionBenchmark.default_patients,
+                                ImportBenchmark.default_runs))
+    parser.add_argument('-s', '--seed',
+                        dest='seed',
+                        metavar='SEED',
+                        type=int,
+                        default=0,
+                        required=False,
+                        help='Seed of the random samples generator')
+    parser.add_argument('-j', '--jobs',
+                        dest='jobs',
+                        metavar='JOBS',
+                        type=int,
+                        default=1,
+                        required=False,
+                        help='Number of worker processes of the '
+                             'extraction benchmark')
+    parser.add_argument('-o', '--output',
+                        dest='output',
+                        metavar='WORK_DIRECTORY',
+                        required=False,
+                        help='Directory the extraction benchmark keeps '
+                             'its synthetic dataset and output in, the '
+                             'dataset is reused by the next runs with '
+                             'the same parameters. A temporary directory '
+                             'is used and removed by default')
+    parser.add_argument('-r', '--report',
+                        dest='report',
+                        metavar='REPORT',
+                        required=False,
+                        help='File the extraction benchmark writes '
+                             'timings, throughput and peak memory of '
+                             'its stages to as json, the imports '
+                             'benchmark its startup times')
+    parser.add_argument('-c', '--compare',
+                        dest='baseline',
+                        metavar='BASELINE',
+                        required=False,
+                        help='Report of a previous extraction benchmark '
+                             'run, the benchmark fails if throughput of '
+                             'any stage is lower than in that report '
+                             'by more than the tolerance')
+    parser.add_argument('-t', '--tolerance',
+                        dest='tolerance',
+                        metavar='TOLERANCE',
+                        type=float,
+                        default=default_tolerance,
+                        required=False,
+                        help='Allowed relative throughput drop compared '
+                             'to the baseline, {} by default'
+                        .format(default_tolerance))
+    LoggerUtils.add_log_level_argument(parser)
+    args = parser.parse_args()
+    LoggerUtils.set_level(args.log_level)
+
+    if args.benchmark not in supported_benchmarks:
+        print('Benchmark is not supported: {}!'.format(args.benchmark))
+        parser.print_help()
+        exit(-1)
+
+    if not supported_benchmarks[args.benchmark](args):
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
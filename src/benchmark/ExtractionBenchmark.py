@@ -0,0 +1,175 @@
+# coding=utf-8
+from json import dump
+from json import load
+from os import remove
+from os.path import isfile
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from timeit import default_timer
+
+from numpy.random import RandomState
+
+from Instrumentation import peak_memory
+from LoggerUtils import LoggerUtils
+from benchmark.SyntheticDataset import generate_dataset
+from benchmark.SyntheticDataset import nodules_per_patient
+from benchmark.SyntheticDataset import readers
+from benchmark.SyntheticDataset import slices_per_series
+from extract.AnnotationStore import open_store
+from extract.AnnotationsLoader import cache_file_name as annotations_cache
+from extract.DicomLoader import cache_file_name as dicom_cache
+from extract.ImageExtractor import extract_images
+from extract.ImageExtractor import read_annotations
+from extract.ImageExtractor import read_diagnosis
+from extract.ImageExtractor import read_dicoms_metadata
+from extract.ImageExtractor import slices_cache_name
+from extract.ImageExtractor import slices_store_name
+from extract.PatientDiagnosisLoader import cache_file_name as \
+    diagnosis_cache
+
+log = LoggerUtils.get_logger('ExtractionBenchmark')
+default_patients = 10
+dataset_file_name = 'dataset.json'
+# relative drop of a stage throughput reported as a regression
+default_tolerance = 0.2
+
+
+def run_stage(stages, stage, unit, function, count):
+    start = default_timer()
+    result = function()
+    elapsed = default_timer() - start
+    items = count(result)
+    stages[stage] = {
+        'seconds': elapsed,
+        'items': items,
+        'unit': unit,
+        'throughput': items / max(elapsed, 1e-9),
+        'peak_memory_mb': peak_memory()
+    }
+
+    log.info('{}: {} {} in {:.3f} s, {:.1f} {}/s, peak memory {} MB'
+             .format(stage, items, unit, elapsed,
+                     stages[stage]['throughput'], unit,
+                     stages[stage]['peak_memory_mb']))
+    return result
+
+
+def prepare_dataset(path, parameters, random):
+    # a dataset generated with the same parameters is reused
+    description = join(path, dataset_file_name)
+
+    if isfile(description):
+        with open(description) as f:
+            if load(f) == parameters:
+                log.info('Reusing synthetic dataset {}'.format(path))
+                return join(path, 'dicom'), join(path, 'annotations'), \
+                    join(path, 'diagnosis')
+
+    log.info('Generating synthetic dataset of {} patients in {}'
+             .format(parameters['patients'], path))
+    start = default_timer()
+    paths = generate_dataset(path, parameters['patients'], random)
+
+    with open(description, 'w') as f:
+        dump(parameters, f)
+
+    log.info('Dataset has been generated in {:.3f} s'
+             .format(default_timer() - start))
+    return paths
+
+
+def remove_caches(dicom_path, annotations_path, diagnosis_path):
+    # loading stages are measured without their incremental caches
+    for cache_file in (join(dicom_path, dicom_cache),
+                       join(annotations_path, annotations_cache),
+                       join(diagnosis_path, diagnosis_cache)):
+        if isfile(cache_file):
+            remove(cache_file)
+
+
+def find_regressions(stages, baseline, tolerance):
+    regressions = []
+
+    for stage, result in sorted(stages.items()):
+        expected = baseline.get(stage)
+
+        if expected is None:
+            continue
+
+        if result['throughput'] < expected['throughput'] * \
+                (1 - tolerance):
+            regressions.append(stage)
+            log.error('{} throughput {:.1f} {}/s is lower than the '
+                      'baseline {:.1f} {}/s'
+                      .format(stage, result['throughput'], result['unit'],
+                              expected['throughput'], expected['unit']))
+
+    return regressions
+
+
+def run(args):
+    work_path = args.output or mkdtemp(prefix='extraction_benchmark')
+    parameters = {
+        'patients': args.number or default_patients,
+        'seed': args.seed,
+        'slices_per_series': slices_per_series,
+        'nodules_per_patient': nodules_per_patient,
+        'readers': readers
+    }
+
+    try:
+        dicom_path, annotations_path, diagnosis_path = \
+            prepare_dataset(join(work_path, 'dataset'), parameters,
+                            RandomState(args.seed))
+        output_path = join(work_path, 'output')
+        stages = {}
+
+        remove_caches(dicom_path, annotations_path, diagnosis_path)
+        rmtree(output_path, ignore_errors=True)
+
+        run_stage(stages, 'annotations', 'nodules',
+                  lambda: read_annotations(annotations_path, args.jobs),
+                  len)
+        run_stage(stages, 'diagnosis', 'patients',
+                  lambda: read_diagnosis(diagnosis_path),
+                  len)
+        run_stage(stages, 'metadata', 'files',
+                  lambda: read_dicoms_metadata(dicom_path, args.jobs),
+                  lambda metadata: sum([len(images) for study
+                                        in metadata.values()
+                                        for images in study.values()]))
+        # loaders are served by the caches built above,
+        # so this stage is mostly the extraction of slices
+        run_stage(stages, 'extraction', 'slices',
+                  lambda: extract_images(dicom_path,
+                                         annotations_path,
+                                         diagnosis_path,
+                                         output_path,
+                                         False,
+                                         False,
+                                         args.jobs),
+                  lambda _: open_store(join(output_path,
+                                            slices_store_name),
+                                       join(output_path,
+                                            slices_cache_name))
+                  .slices_count)
+
+        if args.report:
+            with open(args.report, 'w') as f:
+                dump({'parameters': parameters,
+                      'jobs': args.jobs,
+                      'stages': stages}, f, indent=2, sort_keys=True)
+            log.info('Benchmark report has been written: {}'
+                     .format(args.report))
+
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = load(f)['stages']
+
+            return not find_regressions(stages, baseline, args.tolerance)
+
+        return True
+    finally:
+        if not args.output:
+            rmtree(work_path, ignore_errors=True)
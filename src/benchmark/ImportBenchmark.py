@@ -0,0 +1,109 @@
+# coding=utf-8
+from json import dump
+from json import loads
+from os.path import abspath
+from os.path import dirname
+from os.path import join
+from shutil import rmtree
+from subprocess import PIPE
+from subprocess import Popen
+from sys import executable
+from tempfile import mkdtemp
+from timeit import default_timer
+
+from LoggerUtils import LoggerUtils
+
+log = LoggerUtils.get_logger('ImportBenchmark')
+default_runs = 5
+# invalid invocations must not wait for the learning frameworks
+max_startup_seconds = 1.0
+heavy_modules = ('keras', 'tensorflow', 'theano', 'sklearn', 'matplotlib',
+                 'PIL')
+scripts = ('extract.py', 'learning.py', 'benchmark.py')
+# the help and a missing required argument both end in argparse
+invocations = (('help', ['-h']), ('invalid', []))
+source_path = dirname(dirname(abspath(__file__)))
+
+# runs a command line script the way python does and prints the heavy
+# modules it has loaded, even when argparse exits
+probe = '''
+import json, runpy, sys
+sys.path.insert(0, {path!r})
+sys.argv = [{script!r}] + {arguments!r}
+try:
+    runpy.run_path({script!r}, run_name='__main__')
+except SystemExit:
+    pass
+print(json.dumps(sorted(set(m.split('.')[0] for m in sys.modules)
+                        & set({heavy!r}))))
+'''
+
+
+def measure(script, arguments, work_path):
+    code = probe.format(path=source_path,
+                        script=join(source_path, script),
+                        arguments=arguments,
+                        heavy=heavy_modules)
+    start = default_timer()
+    process = Popen([executable, '-c', code], cwd=work_path,
+                    stdout=PIPE, stderr=PIPE, universal_newlines=True)
+    output, _ = process.communicate()
+    elapsed = default_timer() - start
+    # the last line is printed by the probe after the usage
+    loaded = loads(output.strip().splitlines()[-1])
+    return elapsed, loaded
+
+
+def run(args):
+    runs = args.number or default_runs
+    # scripts create their logs directory in the working directory
+    work_path = mkdtemp(prefix='import_benchmark')
+    results = {}
+    passed = True
+
+    try:
+        for script in scripts:
+            for invocation, arguments in invocations:
+                timings = []
+                loaded = set()
+
+                for _ in range(runs):
+                    elapsed, modules = measure(script, arguments, work_path)
+                    timings.append(elapsed)
+                    loaded.update(modules)
+
+                timings.sort()
+                name = '{} {}'.format(script, invocation)
+                results[name] = {
+                    'median_seconds': timings[len(timings) // 2],
+                    'min_seconds': timings[0],
+                    'max_seconds': timings[-1],
+                    'heavy_modules': sorted(loaded)
+                }
+
+                log.info('{}: median {:.3f} s, min {:.3f} s, max {:.3f} s '
+                         'of {} runs, heavy modules: {}'
+                         .format(name, results[name]['median_seconds'],
+                                 timings[0], timings[-1], runs,
+                                 ', '.join(sorted(loaded)) or 'none'))
+
+                if loaded:
+                    passed = False
+                    log.error('{} loads {}'.format(name,
+                                                   ', '.join(sorted(loaded))))
+
+                if results[name]['median_seconds'] > max_startup_seconds:
+                    passed = False
+                    log.error('{} starts in more than {} s'
+                              .format(name, max_startup_seconds))
+    finally:
+        rmtree(work_path, ignore_errors=True)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            dump({'runs': runs, 'invocations': results}, f, indent=2,
+                 sort_keys=True)
+        log.info('Benchmark report has been written: {}'
+                 .format(args.report))
+
+    return passed
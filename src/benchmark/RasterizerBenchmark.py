@@ -0,0 +1,87 @@
+# coding=utf-8
+from math import pi
+from timeit import default_timer
+
+from numpy import array
+from numpy import cos
+from numpy import linspace
+from numpy import mgrid
+from numpy import sin
+from numpy import vstack
+from numpy.random import RandomState
+
+from LoggerUtils import LoggerUtils
+from extract.Rasterizer import bounding_box
+from extract.Rasterizer import polygon_mask
+
+log = LoggerUtils.get_logger('RasterizerBenchmark')
+image_size = 512
+default_contours = 1000
+
+
+def random_contour(random):
+    # closed 8-connected pixel chain, like LIDC edge maps
+    harmonics = random.randint(2, 6)
+    amplitudes = random.uniform(0, 0.3, harmonics)
+    phases = random.uniform(0, 2 * pi, harmonics)
+    radius = random.uniform(3, 30)
+    x0, y0 = random.uniform(radius * 2, image_size - radius * 2, 2)
+    angles = linspace(0, 2 * pi, 720, endpoint=False)
+    radii = radius * (1 + sum(a * sin((i + 1) * angles + p)
+                              for i, (a, p)
+                              in enumerate(zip(amplitudes, phases))))
+    points = []
+
+    for x, y in zip((x0 + radii * cos(angles)).round().astype(int),
+                    (y0 + radii * sin(angles)).round().astype(int)):
+        if not points or points[-1] != (x, y):
+            points.append((x, y))
+
+    if random.randint(2):
+        points.reverse()
+
+    points.append(points[0])
+    return array([x for x, _ in points]), array([y for _, y in points])
+
+
+def reference_mask(xc, yc, x_min, y_min, x_max, y_max):
+    # the way DicomLoader.contour computed masks before
+    from matplotlib.path import Path
+
+    y_grid, x_grid = mgrid[:image_size, :image_size]
+    xy_pix = vstack((x_grid.ravel(), y_grid.ravel())).T
+    pth = Path(vstack((xc, yc)).T, closed=True)
+    mask = pth.contains_points(xy_pix, radius=-1) \
+        .reshape((image_size, image_size))
+    return mask[y_min:y_max, x_min:x_max]
+
+
+def measure(function, contours):
+    start = default_timer()
+    masks = [function(xc, yc, *bounding_box(xc, yc))
+             for xc, yc in contours]
+    return default_timer() - start, masks
+
+
+def run(args):
+    random = RandomState(args.seed)
+    contours = [random_contour(random)
+                for _ in range(args.number or default_contours)]
+
+    log.info('Rasterizing {} random contours'.format(len(contours)))
+
+    reference_time, reference_masks = measure(reference_mask, contours)
+    rasterizer_time, rasterizer_masks = measure(polygon_mask, contours)
+
+    mismatches = sum([(a != b).any() for a, b
+                      in zip(reference_masks, rasterizer_masks)])
+
+    log.info('matplotlib full image: {:.3f} ms per contour'
+             .format(reference_time * 1000 / len(contours)))
+    log.info('bounding box rasterizer: {:.3f} ms per contour'
+             .format(rasterizer_time * 1000 / len(contours)))
+    log.info('Speedup: {:.1f}x, {} of {} masks differ'
+             .format(reference_time / rasterizer_time,
+                     mismatches, len(contours)))
+
+    return mismatches == 0
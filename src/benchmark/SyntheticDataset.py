@@ -0,0 +1,256 @@
+# coding=utf-8
+from math import pi
+from os import makedirs
+from os.path import join
+from struct import pack
+
+from numpy import cos
+from numpy import int16
+from numpy import linspace
+from numpy import mgrid
+from numpy import sin
+
+from extract.DicomHeaderReader import long_vrs
+
+# Synthetic LIDC-like dataset: every patient has one CT series with
+# explicit VR little endian dicom files, an annotations xml file with
+# the reading sessions of several radiologists and a diagnosis row
+# (every tenth patient has none). Images are noisy lungs with bright
+# nodules, so windowing and png compression do realistic work.
+image_size = 512
+slices_per_series = 32
+nodules_per_patient = 3
+readers = 4
+slice_thickness = 2.5
+pixel_spacing = 0.7
+rescale_intercept = -1024
+ct_image_storage = '1.2.840.10008.5.1.4.1.1.2'
+explicit_little_endian = '1.2.840.10008.1.2.1'
+implementation_uid = '2.25.1'
+xml_namespace = 'http://www.nih.gov'
+
+
+def random_uid(random):
+    # uuid derived uids are unique without a registered root
+    return '2.25.{}'.format(int.from_bytes(random.bytes(16), 'big'))
+
+
+def patient_id(number):
+    return 'LIDC-IDRI-{:04d}'.format(number)
+
+
+def data_element(group, element, vr, value):
+    if isinstance(value, str):
+        value = value.encode('ascii')
+
+        if len(value) % 2:
+            value += b'\x00' if vr == 'UI' else b' '
+
+    vr = vr.encode('ascii')
+
+    if vr in long_vrs:
+        return pack('<HH2s2xI', group, element, vr, len(value)) + value
+
+    return pack('<HH2sH', group, element, vr, len(value)) + value
+
+
+def dicom_file(image_uid, study, series, patient, number, z_pos, pixels):
+    meta = b''.join([
+        data_element(0x0002, 0x0001, 'OB', b'\x00\x01'),
+        data_element(0x0002, 0x0002, 'UI', ct_image_storage),
+        data_element(0x0002, 0x0003, 'UI', image_uid),
+        data_element(0x0002, 0x0010, 'UI', explicit_little_endian),
+        data_element(0x0002, 0x0012, 'UI', implementation_uid)])
+    rows, columns = pixels.shape
+    elements = [
+        data_element(0x0008, 0x0016, 'UI', ct_image_storage),
+        data_element(0x0008, 0x0018, 'UI', image_uid),
+        data_element(0x0008, 0x0060, 'CS', 'CT'),
+        data_element(0x0010, 0x0010, 'PN', patient),
+        data_element(0x0010, 0x0020, 'LO', patient),
+        data_element(0x0018, 0x0050, 'DS', str(slice_thickness)),
+        data_element(0x0020, 0x000D, 'UI', study),
+        data_element(0x0020, 0x000E, 'UI', series),
+        data_element(0x0020, 0x0013, 'IS', str(number)),
+        data_element(0x0020, 0x0032, 'DS', '-180\\-180\\{}'.format(z_pos)),
+        data_element(0x0020, 0x1041, 'DS', str(z_pos)),
+        data_element(0x0028, 0x0002, 'US', pack('<H', 1)),
+        data_element(0x0028, 0x0004, 'CS', 'MONOCHROME2'),
+        data_element(0x0028, 0x0010, 'US', pack('<H', rows)),
+        data_element(0x0028, 0x0011, 'US', pack('<H', columns)),
+        data_element(0x0028, 0x0030, 'DS',
+                     '{0}\\{0}'.format(pixel_spacing)),
+        data_element(0x0028, 0x0100, 'US', pack('<H', 16)),
+        data_element(0x0028, 0x0101, 'US', pack('<H', 16)),
+        data_element(0x0028, 0x0102, 'US', pack('<H', 15)),
+        data_element(0x0028, 0x0103, 'US', pack('<H', 1)),
+        data_element(0x0028, 0x1052, 'DS', str(rescale_intercept)),
+        data_element(0x0028, 0x1053, 'DS', '1'),
+        data_element(0x7FE0, 0x0010, 'OW',
+                     pixels.astype('<i2').tobytes())]
+    return b''.join([b'\x00' * 128, b'DICM',
+                     data_element(0x0002, 0x0000, 'UL',
+                                  pack('<I', len(meta))),
+                     meta] + elements)
+
+
+def nodule_contour(random, x0, y0, radius):
+    # closed 8-connected pixel chain around the centre
+    harmonics = random.randint(2, 5)
+    amplitudes = random.uniform(0, 0.2, harmonics)
+    phases = random.uniform(0, 2 * pi, harmonics)
+    angles = linspace(0, 2 * pi, max(int(radius * 16), 32),
+                      endpoint=False)
+    radii = radius * (1 + sum(a * sin((i + 1) * angles + p)
+                              for i, (a, p)
+                              in enumerate(zip(amplitudes, phases))))
+    points = []
+
+    for x, y in zip((x0 + radii * cos(angles)).round().astype(int),
+                    (y0 + radii * sin(angles)).round().astype(int)):
+        if not points or points[-1] != (x, y):
+            points.append((x, y))
+
+    points.append(points[0])
+    return points
+
+
+def random_nodules(random):
+    # (centre x, centre y, radius, first slice, slices count)
+    nodules = []
+
+    for _ in range(nodules_per_patient):
+        # left or right lung
+        x0 = image_size * (0.3 if random.randint(2) else 0.7) + \
+            random.uniform(-0.08, 0.08) * image_size
+        y0 = image_size * random.uniform(0.35, 0.65)
+        radius = random.uniform(4, 20)
+        count = random.randint(3, min(9, slices_per_series + 1))
+        first = random.randint(0, slices_per_series - count + 1)
+        nodules.append((x0, y0, radius, first, count))
+
+    return nodules
+
+
+def series_background(random):
+    # air outside of the body, soft tissue and two lungs
+    y, x = mgrid[:image_size, :image_size] / float(image_size)
+    body = ((x - 0.5) / 0.45) ** 2 + ((y - 0.5) / 0.35) ** 2 < 1
+    lungs = (((abs(x - 0.5) - 0.2) / 0.15) ** 2 +
+             ((y - 0.5) / 0.22) ** 2) < 1
+    hounsfield = body * 1040.0 - 1000.0
+    hounsfield[lungs] = -850.0 + random.uniform(-30, 30)
+    return hounsfield
+
+
+def slice_pixels(random, background, nodules, index):
+    hounsfield = background + random.normal(0, 25, background.shape)
+    y, x = mgrid[:image_size, :image_size]
+
+    for x0, y0, radius, first, count in nodules:
+        if first <= index < first + count:
+            # nodules are the widest in their middle slice
+            scale = 1 - abs(index - first - (count - 1) / 2.0) / count
+            inside = (x - x0) ** 2 + (y - y0) ** 2 < (radius * scale) ** 2
+            hounsfield[inside] = 30.0 + random.normal(0, 25,
+                                                      inside.sum())
+
+    return (hounsfield - rescale_intercept).round().astype(int16)
+
+
+def annotations_xml(random, study, series, image_uids, z_positions,
+                    nodules):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<LidcReadMessage uid="{}" xmlns="{}">'
+             .format(random_uid(random), xml_namespace),
+             '<ResponseHeader><Version>1.8.1</Version>'
+             '<StudyInstanceUID>{}</StudyInstanceUID>'
+             '<SeriesInstanceUid>{}</SeriesInstanceUid>'
+             '</ResponseHeader>'.format(study, series)]
+
+    for reader in range(readers):
+        lines.append('<readingSession><servicingRadiologistID>{}'
+                     '</servicingRadiologistID>'.format(reader))
+
+        for number, (x0, y0, radius, first, count) in enumerate(nodules):
+            lines.append('<unblindedReadNodule>'
+                         '<noduleID>Nodule {:03d}</noduleID>'
+                         '<characteristics><malignancy>{}</malignancy>'
+                         '</characteristics>'
+                         .format(number + 1, random.randint(1, 6)))
+
+            for index in range(first, first + count):
+                scale = 1 - abs(index - first - (count - 1) / 2.0) / count
+                # every reader draws a slightly different contour
+                points = nodule_contour(random,
+                                        x0 + random.uniform(-1, 1),
+                                        y0 + random.uniform(-1, 1),
+                                        max(radius * scale, 2) *
+                                        random.uniform(0.9, 1.1))
+                lines.append('<roi><imageZposition>{}</imageZposition>'
+                             '<imageSOP_UID>{}</imageSOP_UID>'
+                             '<inclusion>TRUE</inclusion>'
+                             .format(z_positions[index],
+                                     image_uids[index]))
+                lines.extend(['<edgeMap><xCoord>{}</xCoord>'
+                              '<yCoord>{}</yCoord></edgeMap>'
+                              .format(x, y) for x, y in points])
+                lines.append('</roi>')
+
+            lines.append('</unblindedReadNodule>')
+
+        lines.append('</readingSession>')
+
+    lines.append('</LidcReadMessage>')
+    return '\n'.join(lines)
+
+
+def write_patient(random, number, dicom_path, annotations_path):
+    patient = patient_id(number)
+    study = random_uid(random)
+    series = random_uid(random)
+    series_path = join(dicom_path, patient, study, series)
+    image_uids = [random_uid(random) for _ in range(slices_per_series)]
+    z_positions = [-slice_thickness * i for i in range(slices_per_series)]
+    nodules = random_nodules(random)
+    background = series_background(random)
+
+    makedirs(series_path, exist_ok=True)
+
+    for index, (image_uid, z_pos) in enumerate(zip(image_uids,
+                                                   z_positions)):
+        pixels = slice_pixels(random, background, nodules, index)
+
+        with open(join(series_path, '{:06d}.dcm'.format(index + 1)),
+                  'wb') as f:
+            f.write(dicom_file(image_uid, study, series, patient,
+                               index + 1, z_pos, pixels))
+
+    with open(join(annotations_path, '{:04d}.xml'.format(number)),
+              'w', encoding='utf-8') as f:
+        f.write(annotations_xml(random, study, series, image_uids,
+                                z_positions, nodules))
+
+
+def generate_dataset(path, patients, random):
+    # returns dicom, annotations and diagnosis directories
+    dicom_path = join(path, 'dicom')
+    annotations_path = join(path, 'annotations')
+    diagnosis_path = join(path, 'diagnosis')
+
+    for directory in (dicom_path, annotations_path, diagnosis_path):
+        makedirs(directory, exist_ok=True)
+
+    diagnosis = []
+
+    for number in range(patients):
+        write_patient(random, number, dicom_path, annotations_path)
+
+        if number % 10 != 9:
+            diagnosis.append('{},{}\n'.format(patient_id(number),
+                                              random.randint(0, 4)))
+
+    with open(join(diagnosis_path, 'diagnosis.csv'), 'w') as f:
+        f.writelines(diagnosis)
+
+    return dicom_path, annotations_path, diagnosis_path
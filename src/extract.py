@@ -2,11 +2,17 @@
 import logging
 from argparse import ArgumentParser
 from importlib import reload
+from os.path import join
 
+from Instrumentation import instrumentation
+from LoggerUtils import LoggerUtils
+from extract.Hounsfield import lung_window
 from extract.ImageExtractor import extract_images
 
 reload(logging)
 
+metrics_file_name = 'extraction.metrics.json'
+
 
 def main():
     parser = ArgumentParser(
@@ -57,13 +63,92 @@ def main():
                         action='store_true',
                         help='If set, full CT scans will be '
                              'extracted in a "full" subdirectory')
+    parser.add_argument('-j', '--jobs',
+                        dest='jobs',
+                        metavar='JOBS',
+                        type=int,
+                        default=1,
+                        required=False,
+                        help='Number of worker processes used to '
+                             'parse annotations, to scan dicom files '
+                             'metadata and to extract nodule images')
+    parser.add_argument('-p', '--packed',
+                        dest='export_packed',
+                        default=False,
+                        required=False,
+                        action='store_true',
+                        help='If set, nodule images will be packed into '
+                             'a single memory mapped store instead of '
+                             'being saved as separate png files')
+    parser.add_argument('-v', '--volumes',
+                        dest='export_volumes',
+                        default=False,
+                        required=False,
+                        action='store_true',
+                        help='If set, every series with nodules will be '
+                             'exported as an int16 volume in Hounsfield '
+                             'units sorted by z position in a "volumes" '
+                             'subdirectory')
+    parser.add_argument('-w', '--window',
+                        dest='window',
+                        metavar=('LEVEL', 'WIDTH'),
+                        type=float,
+                        nargs=2,
+                        default=lung_window,
+                        required=False,
+                        help='Hounsfield units window the images are '
+                             'mapped to gray levels with, the lung '
+                             'window {} {} by default'
+                             .format(*lung_window))
+    parser.add_argument('-r', '--resume',
+                        dest='resume',
+                        default=False,
+                        required=False,
+                        action='store_true',
+                        help='If set, extracted slices are recorded in a '
+                             'journal in the output directory, so an '
+                             'interrupted extraction can be resumed by '
+                             'running it again with this flag')
+    parser.add_argument('-t', '--threads',
+                        dest='writer_threads',
+                        metavar='THREADS',
+                        type=int,
+                        default=2,
+                        required=False,
+                        help='Number of threads encoding and writing png '
+                             'files in every extraction process, 0 to '
+                             'write them in the extracting thread')
+    parser.add_argument('-i', '--index',
+                        dest='export_index',
+                        default=False,
+                        required=False,
+                        action='store_true',
+                        help='If set, dicom metadata, extracted nodules '
+                             'and diagnosis are also written into an '
+                             'sqlite index in the output directory')
+    LoggerUtils.add_log_level_argument(parser)
     args = parser.parse_args()
-    extract_images(args.dicom,
-                   args.annotations,
-                   args.diagnosis,
-                   args.output_directory,
-                   args.export_all_images,
-                   args.export_full_images)
+    LoggerUtils.set_level(args.log_level)
+
+    if args.window[1] <= 0:
+        parser.error('window width must be positive')
+
+    with instrumentation.stage('total'):
+        extract_images(args.dicom,
+                       args.annotations,
+                       args.diagnosis,
+                       args.output_directory,
+                       args.export_all_images,
+                       args.export_full_images,
+                       args.jobs,
+                       args.export_packed,
+                       args.export_volumes,
+                       tuple(args.window),
+                       args.resume,
+                       args.writer_threads,
+                       args.export_index)
+
+    instrumentation.write(join(args.output_directory, metrics_file_name))
 
 
 if __name__ == '__main__':
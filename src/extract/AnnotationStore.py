@@ -0,0 +1,255 @@
+# coding=utf-8
+from collections import OrderedDict
+from os.path import getmtime
+from os.path import isfile
+
+from numpy import arange
+from numpy import array
+from numpy import concatenate
+from numpy import cumsum
+from numpy import frombuffer
+from numpy import load as load_array
+from numpy import ones
+from numpy import repeat
+from numpy import zeros
+
+from LoggerUtils import LoggerUtils
+from ManifestCache import ManifestCache
+from Utils import CacheError
+from Utils import cache_fingerprint
+from Utils import encode_strings
+from Utils import group_maxima
+from Utils import load_cache
+from Utils import load_pickle
+from Utils import load_table
+from Utils import new_directory
+from Utils import replace_directory
+from Utils import save_table
+from Utils import table_file
+from extract.AnnotationsLoader import cache_version as annotations_version
+from extract.AnnotationsLoader import merge_nodules
+from extract.AnnotationsLoader import slice_order
+from extract.Nodule import Nodule
+from extract.Slice import Slice
+from extract.Slice import vertex_type
+
+log = LoggerUtils.get_logger('AnnotationStore')
+store_version = 1
+
+# Nodules and slices are kept as tables of columns, the slices of a
+# nodule are the rows [slice_start, slice_start + slice_count) of the
+# slices table and the vertices of a slice are the rows
+# [vertex_start, vertex_start + vertex_count) of one vertex buffer
+nodule_columns = ('study', 'series', 'nodule_id', 'malignancy',
+                  'slice_start', 'slice_count')
+slice_columns = ('nodule', 'image_uid', 'z_pos', 'area', 'uid',
+                 'vertex_start', 'vertex_count')
+
+
+def offsets(counts):
+    return cumsum(counts) - counts
+
+
+def write_store(path, nodules, fingerprint=''):
+    nodules = sorted(nodules, key=lambda n: n.key)
+    nodule_slices = [sorted(n.slices, key=slice_order) for n in nodules]
+    slices = [s for n in nodule_slices for s in n]
+    slice_counts = array([len(n) for n in nodule_slices], dtype='int64')
+    vertex_counts = array([len(s.vertices) for s in slices], dtype='int64')
+
+    nodules_table = {
+        'study': encode_strings([n.study for n in nodules]),
+        'series': encode_strings([n.series for n in nodules]),
+        'nodule_id': encode_strings([n.nodule_id for n in nodules]),
+        'malignancy': encode_strings(['' if n.malignancy is None
+                                      else str(n.malignancy)
+                                      for n in nodules]),
+        'slice_start': offsets(slice_counts),
+        'slice_count': slice_counts
+    }
+    slices_table = {
+        'nodule': repeat(arange(len(nodules), dtype='int32'), slice_counts),
+        'image_uid': encode_strings([s.image_uid for s in slices]),
+        'z_pos': array([s.z_pos for s in slices], dtype='float64'),
+        'area': array([s.area for s in slices], dtype='int32'),
+        'uid': frombuffer(b''.join([bytes.fromhex(s.uid) for s in slices]),
+                          dtype='uint8').reshape(-1, 16),
+        'vertex_start': offsets(vertex_counts),
+        'vertex_count': vertex_counts
+    }
+    vertices = concatenate([s.vertices for s in slices]) if slices \
+        else zeros((0, 2), dtype=vertex_type)
+
+    temp_path = path + '.tmp'
+    new_directory(temp_path)
+    save_table(temp_path, 'nodules', nodules_table)
+    save_table(temp_path, 'slices', slices_table)
+    save_table(temp_path, 'vertices', {'xy': vertices})
+    # fingerprint of the extraction the nodules come from
+    save_table(temp_path, 'store', {'version': array([store_version]),
+                                    'fingerprint':
+                                        encode_strings([fingerprint])})
+
+    replace_directory(temp_path, path)
+    log.info('Annotation store with {} nodules and {} slices has been '
+             'written: {}'.format(len(nodules), len(slices), path))
+
+
+def load_cached_nodules(cache_file, fingerprint=None):
+    try:
+        cache = load_cache(cache_file, fingerprint)
+    except CacheError:
+        # output folders extracted by older versions
+        cache = load_pickle(cache_file)
+
+    if not isinstance(cache, dict):
+        # extracted slices and old annotation caches are
+        # plain collections of nodules
+        return list(cache)
+
+    manifest = ManifestCache(cache_file, log, annotations_version)
+    manifest.load()
+    nodules = {}
+
+    for _, file_nodules in manifest.entries():
+        merge_nodules(nodules, file_nodules)
+
+    return list(nodules.values())
+
+
+def source_of(cache_file):
+    # None if the store can't be checked against the cache
+    if not isfile(cache_file):
+        return None
+
+    try:
+        return cache_fingerprint(cache_file)
+    except CacheError:
+        # pickles of older versions
+        return ''
+
+
+def convert_cache(cache_file, path, fingerprint=None):
+    log.info('Converting pickled nodules {} to annotation store {}'
+             .format(cache_file, path))
+    write_store(path, load_cached_nodules(cache_file, fingerprint),
+                fingerprint or '')
+    return AnnotationStore(path)
+
+
+def open_store(path, cache_file):
+    # the store is rebuilt from the pickled nodules when it is
+    # missing, unreadable, older than the pickle or built by
+    # another extraction
+    version_file = table_file(path, 'store', 'version')
+    fingerprint = source_of(cache_file)
+
+    if isfile(version_file) and not (isfile(cache_file) and
+                                     getmtime(cache_file) >
+                                     getmtime(version_file)):
+        try:
+            store = AnnotationStore(path)
+
+            if fingerprint is None or store.fingerprint == fingerprint:
+                return store
+
+            log.info('Annotation store {} has been built by another '
+                     'extraction, it will be rebuilt'.format(path))
+        except (IOError, ValueError):
+            log.warn('Can\'t open annotation store {}, it will be rebuilt'
+                     .format(path), exc_info=True)
+
+    return convert_cache(cache_file, path, fingerprint)
+
+
+class AnnotationStore(object):
+    def __init__(self, path):
+        version = load_table(path, 'store', ('version',))['version']
+
+        if version.shape != (1,) or version[0] != store_version:
+            raise ValueError('Annotation store {} has an unsupported '
+                             'version'.format(path))
+
+        self._path = path
+        self._nodules = load_table(path, 'nodules', nodule_columns)
+        self._slices = load_table(path, 'slices', slice_columns)
+        self._vertices = load_table(path, 'vertices', ('xy',))['xy']
+        fingerprint_file = table_file(path, 'store', 'fingerprint')
+        # stores written before fingerprints have none
+        self._fingerprint = load_array(fingerprint_file)[0] \
+            .decode('utf-8') if isfile(fingerprint_file) else ''
+
+    @property
+    def fingerprint(self):
+        return self._fingerprint
+
+    @property
+    def nodules_count(self):
+        return len(self._nodules['study'])
+
+    @property
+    def slices_count(self):
+        return len(self._slices['nodule'])
+
+    def select(self, studies=None, min_area=None):
+        # mask of the slices of the given studies with an area
+        # greater than min_area
+        selected = ones(self.slices_count, dtype=bool)
+
+        if studies is not None:
+            studies = set([s.encode('utf-8') for s in studies])
+            nodules = array([s in studies for s in self._nodules['study']],
+                            dtype=bool)
+            selected &= nodules[self._slices['nodule']]
+
+        if min_area is not None:
+            selected &= self._slices['area'] > min_area
+
+        return selected
+
+    def load_nodules(self, studies=None, min_area=None):
+        return self._materialize(self.select(studies, min_area).nonzero()[0])
+
+    def biggest_slices(self, studies=None, min_area=None):
+        # nodules with their biggest slice only, the biggest one has
+        # to be greater than min_area. Of the slices with the same
+        # area the last stored one is taken.
+        biggest = group_maxima(self._slices['nodule'], self._slices['area'])
+
+        return self._materialize(
+            biggest[self.select(studies, min_area)[biggest]])
+
+    def _materialize(self, rows):
+        rows = array(rows, dtype='int64')
+        rows.sort()
+        columns = dict((c, self._slices[c][rows]) for c in slice_columns)
+        nodules = OrderedDict()
+
+        for i in range(len(rows)):
+            index = int(columns['nodule'][i])
+            nodule = nodules.get(index)
+
+            if nodule is None:
+                nodule = nodules[index] = self._nodule(index)
+
+            start = int(columns['vertex_start'][i])
+            end = start + int(columns['vertex_count'][i])
+            nodule_slice = Slice.__new__(Slice)
+            nodule_slice.__setstate__((
+                columns['image_uid'][i].decode('utf-8'),
+                float(columns['z_pos'][i]),
+                None,
+                int(columns['area'][i]),
+                columns['uid'][i].tobytes(),
+                array(self._vertices[start:end])))
+            nodule.slices.add(nodule_slice)
+
+        return list(nodules.values())
+
+    def _nodule(self, index):
+        nodule = Nodule(self._nodules['study'][index].decode('utf-8'),
+                        self._nodules['series'][index].decode('utf-8'),
+                        self._nodules['nodule_id'][index].decode('utf-8'))
+        malignancy = self._nodules['malignancy'][index].decode('utf-8')
+        nodule.malignancy = malignancy if malignancy else None
+        return nodule
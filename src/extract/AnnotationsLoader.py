@@ -1,249 +1,277 @@
 # coding=utf-8
-from collections import namedtuple
-from os.path import isfile
 from os.path import join
 from re import compile
+from xml.sax import parse
 from xml.sax import parseString
 from xml.sax.handler import ContentHandler
 
+from Instrumentation import instrumentation
 from LoggerUtils import LoggerUtils
-from Utils import create_cache
-from Utils import list_files
-from Utils import load_cache
+from ManifestCache import ManifestCache
+from Utils import map_parallel
+from Utils import scan_files
 from extract.Nodule import Nodule
 from extract.Slice import Slice
+# caches pickled before Point has been moved to Slice refer to it here
+# noinspection PyUnresolvedReferences
+from extract.Slice import Point
 
 log = LoggerUtils.get_logger('AnnotationsLoader')
 non_id_char = compile('[^_0-9a-zA-Z]')
 xml_ext = '.xml'
 cache_file_name = 'annotations.cache'
+cache_version = 3
 
 
 def _name_mangle(name):
     return non_id_char.sub('_', name)
 
 
-Point = namedtuple('Point', 'x y')
+response_header = ('responseheader',)
+reading_session = ('readingsession',)
+unblinded_nodule = reading_session + ('unblindedreadnodule',)
+nodule_roi = unblinded_nodule + ('roi',)
+roi_edge = nodule_roi + ('edgemap',)
 
+header_fields = ('seriesinstanceuid', 'studyinstanceuid')
+nodule_fields = ('noduleid',)
+roi_fields = ('imagesop_uid', 'imagezposition', 'inclusion')
+edge_fields = ('xcoord', 'ycoord')
 
-class CaseInsensitiveDict(dict):
-    def __setitem__(self, key, value):
-        super(CaseInsensitiveDict, self) \
-            .__setitem__(str(key).lower(), value)
 
-    def __getitem__(self, key):
-        return super(CaseInsensitiveDict, self) \
-            .__getitem__(str(key).lower())
-
-    def __contains__(self, key):
-        return super(CaseInsensitiveDict, self) \
-            .__contains__(str(key).lower())
-
-
-class DataNode(object):
-    def __init__(self):
-        self._attributes = CaseInsensitiveDict()
-        self._data = None
-
-    @property
-    def attributes(self):
-        return self._attributes
-
-    @property
-    def data(self):
-        return self._data
-
-    @data.setter
-    def data(self, value):
-        self._data = value
-
-    def __len__(self):
-        return 1
-
-    def __getitem__(self, key):
-        if isinstance(key, str):
-            return self.attributes[key]
-        else:
-            return [self][key]
-
-    def __contains__(self, name):
-        return name in self.attributes
-
-    def __nonzero__(self):
-        return bool(self.attributes or self.data)
-
-    def __getattr__(self, name):
-        if name.startswith('__'):
-            # need to do this for Python special methods???
-            raise AttributeError(name)
-        return self.attributes[name]
-
-    def add_xml_attribute(self, name, value):
-        if name in self.attributes:
-            # multiple attribute of the same name
-            # are represented by a list
-            children = self.attributes[name]
-            if not isinstance(children, list):
-                children = [children]
-                self.attributes[name] = children
-            children.append(value)
-        else:
-            self.attributes[name] = value
-
-    def __str__(self):
-        return self.data or self.__repr__()
-
-    def __repr__(self):
-        items = sorted(self.attributes.items())
-        if self.data:
-            items.append(('data', self.data))
-        return u'{%s}' % ', '.join(
-            [u'%s:%s' % (k, repr(v)) for k, v in items])
+def get_field(record, field, node):
+    value = record.get(field.lower())
+    if value is None:
+        raise ValueError('{} is not presented at node {}'
+                         .format(field, node))
+    else:
+        return value
 
 
-class TreeBuilder(ContentHandler):
-    def __init__(self):
+class NodulesHandler(ContentHandler):
+    # Builds nodules and slices while the document is being read.
+    # Only the reading session being read is buffered, and it is
+    # added to the nodules once it is complete.
+    def __init__(self, nodules):
         super().__init__()
-        self.stack = []
-        self.root = DataNode()
-        self.current = self.root
-        self.text_parts = []
+        self._nodules = nodules
+        self._path = []
+        self._text = None
+        self._header = None
+        self._sessions = 0
+        self._pending_sessions = []
+        self._session = None
+        self._nodule = None
+        self._roi = None
+        self._edge = None
 
     def startElement(self, name, attributes):
-        self.stack.append((self.current, self.text_parts))
-        self.current = DataNode()
-        self.text_parts = []
-        # xml attributes --> python attributes
-        for k, v in attributes.items():
-            self.current.add_xml_attribute(_name_mangle(k), v)
+        self._path.append(_name_mangle(name).lower())
+        path = tuple(self._path[1:])
+        self._text = None
+
+        if path == response_header:
+            self._header = {}
+        elif path == reading_session:
+            self._session = []
+        elif path == unblinded_nodule:
+            self._nodule = {'roi': []}
+        elif path == nodule_roi:
+            self._roi = {'edgemap': []}
+        elif path == roi_edge:
+            self._edge = {}
+        elif self._field_record(path) is not None:
+            self._text = []
 
     def endElement(self, name):
-        text = ''.join(self.text_parts).strip()
-        if text:
-            self.current.data = text
-        if self.current.attributes:
-            obj = self.current
-        else:
-            # a text only node is simply represented by the string
-            obj = text or ''
-        self.current, self.text_parts = self.stack.pop()
-        self.current.add_xml_attribute(_name_mangle(name), obj)
-
-    def characters(self, content):
-        self.text_parts.append(content)
-
-
-def get_field(node, field):
-    if field not in node.attributes:
-        raise ValueError('{} is not presented at node {}'
-                         .format(field, node))
-    else:
-        return node.attributes[field]
+        path = tuple(self._path[1:])
+        record = self._field_record(path)
+
+        if record is not None and self._text is not None:
+            record[path[-1]] = ''.join(self._text).strip()
+        elif path == roi_edge:
+            self._roi['edgemap'].append(self._edge)
+        elif path == nodule_roi:
+            self._nodule['roi'].append(self._roi)
+        elif path == unblinded_nodule:
+            self._session.append(self._nodule)
+        elif path == reading_session:
+            self._sessions += 1
+            if self._header is None:
+                self._pending_sessions.append(self._session)
+            else:
+                self._add_session(self._session)
+        elif not path:
+            self._end_document()
 
+        self._text = None
+        self._path.pop()
 
-def parse_nodules(xml_text, nodules):
-    builder = TreeBuilder()
-    parseString(xml_text.encode('utf-8'), builder)
-    root = next(iter(builder.root.attributes.values()))
-    response_header = get_field(node=root,
-                                field='ResponseHeader')
-    series = get_field(node=response_header,
-                       field='SeriesInstanceUid')
-    study = get_field(node=response_header,
-                      field='StudyInstanceUID')
-    r_sessions = list(get_field(node=root,
-                                field='ReadingSession'))
-    for r_session in r_sessions:
-        unbl_r_nodules = list(get_field(node=r_session,
-                                        field='UnblindedReadNodule'))
-        for unbl_r_nodule in unbl_r_nodules:
-            nodule_id = get_field(node=unbl_r_nodule,
-                                  field='noduleID')
+    def characters(self, content):
+        if self._text is not None:
+            self._text.append(content)
+
+    def _field_record(self, path):
+        parent, field = path[:-1], path[-1:]
+
+        if parent == response_header and field[0] in header_fields:
+            return self._header
+        elif parent == unblinded_nodule and field[0] in nodule_fields:
+            return self._nodule
+        elif parent == nodule_roi and field[0] in roi_fields:
+            return self._roi
+        elif parent == roi_edge and field[0] in edge_fields:
+            return self._edge
+
+        return None
+
+    def _end_document(self):
+        if self._header is None:
+            raise ValueError('ResponseHeader is not presented at '
+                             'node {}'.format(self._path[0]))
+        if not self._sessions:
+            raise ValueError('ReadingSession is not presented at '
+                             'node {}'.format(self._path[0]))
+
+        for session in self._pending_sessions:
+            self._add_session(session)
+
+    def _add_session(self, session):
+        series = get_field(self._header, 'SeriesInstanceUid',
+                           'ResponseHeader')
+        study = get_field(self._header, 'StudyInstanceUID',
+                          'ResponseHeader')
+
+        if not session:
+            raise ValueError('UnblindedReadNodule is not presented '
+                             'at node ReadingSession')
+
+        for unbl_r_nodule in session:
+            nodule_id = get_field(unbl_r_nodule, 'noduleID',
+                                  'UnblindedReadNodule')
             if nodule_id.startswith('Nodule '):
                 nodule_id = nodule_id[7:].strip()
             if nodule_id.isnumeric():
                 nodule_id = str(int(nodule_id))
 
-            rois = list(get_field(node=unbl_r_nodule,
-                                  field='roi'))
+            if not unbl_r_nodule['roi']:
+                raise ValueError('roi is not presented at '
+                                 'node UnblindedReadNodule')
 
-            if not nodules.get((study, series, nodule_id)):
-                nodule = nodules[(study, series, nodule_id)] = \
+            nodule = self._nodules.get((study, series, nodule_id))
+
+            if nodule is None:
+                nodule = self._nodules[(study, series, nodule_id)] = \
                     Nodule(study, series, nodule_id)
-            else:
-                nodule = nodules[(study, series, nodule_id)]
 
-            for roi in rois:
-                image_uid = get_field(node=roi,
-                                      field='imageSOP_UID')
-                z_pos = get_field(node=roi,
-                                  field='imageZposition')
-                inclusion = get_field(node=roi,
-                                      field='inclusion')
+            for roi in unbl_r_nodule['roi']:
+                image_uid = get_field(roi, 'imageSOP_UID', 'roi')
+                z_pos = get_field(roi, 'imageZposition', 'roi')
+                inclusion = get_field(roi, 'inclusion', 'roi')
 
                 if 'true' != inclusion.lower():
                     # to work only with included slices
                     continue
 
-                edge_maps = list(get_field(node=roi,
-                                           field='edgeMap'))
-                points = []
-                for edge in edge_maps:
-                    x = int(get_field(node=edge,
-                                      field='xCoord'))
-                    y = int(get_field(node=edge,
-                                      field='yCoord'))
-                    points.append(Point(x, y))
+                if not roi['edgemap']:
+                    raise ValueError('edgeMap is not presented '
+                                     'at node roi')
+
+                points = [(int(get_field(edge, 'xCoord', 'edgeMap')),
+                           int(get_field(edge, 'yCoord', 'edgeMap')))
+                          for edge in roi['edgemap']]
 
                 nodule.slices.add(Slice(image_uid=image_uid,
                                         z_pos=z_pos,
                                         points=points))
+
+
+def parse_nodules(xml_text, nodules):
+    parseString(xml_text.encode('utf-8'), NodulesHandler(nodules))
     return nodules
 
 
+def parse_nodules_file(file, nodules):
+    parse(file, NodulesHandler(nodules))
+    return nodules
+
+
+def parse_annotations_file(file):
+    nodules = {}
+
+    try:
+        with instrumentation.timer('annotations.parse_seconds'):
+            parse_nodules_file(file, nodules)
+        return file, nodules, False
+    except ValueError:
+        log.error('Can\'t load annotations from file %s', file,
+                  exc_info=True)
+        return file, nodules, True
+
+
+def slice_order(nodule_slice):
+    return nodule_slice.z_pos, nodule_slice.image_uid, \
+        nodule_slice.vertices.tobytes()
+
+
+def merge_nodules(nodules, file_nodules):
+    # slices are added in a fixed order, so merged sets do not depend
+    # on the process the file has been parsed in
+    for key, file_nodule in file_nodules.items():
+        nodule = nodules.get(key)
+
+        if nodule is None:
+            # cached nodules must stay untouched, so every
+            # merged nodule is a fresh object
+            nodule = nodules[key] = Nodule(file_nodule.study,
+                                           file_nodule.series,
+                                           file_nodule.nodule_id)
+
+        nodule.slices.update(sorted(file_nodule.slices, key=slice_order))
+
+
 class AnnotationsLoader(object):
-    def __init__(self, annotations_path):
-        log.info('Annotations directory: {}'.format(annotations_path))
+    def __init__(self, annotations_path, jobs=1):
+        log.info('Annotations directory: %s', annotations_path)
         self._annotations_path = annotations_path
+        self._jobs = jobs
 
     def load_nodules_annotations(self):
-        cache_file = join(self._annotations_path, cache_file_name)
+        cache = ManifestCache(join(self._annotations_path,
+                                   cache_file_name), log, cache_version)
+        cache.load()
+
+        # changed files are parsed while the directory
+        # tree is still being listed
+        files = scan_files(self._annotations_path, xml_ext)
+        file_counter = 1
 
-        if isfile(cache_file):
-            log.info('Found cache file with annotations, '
-                     'delete it to reload: {}. Loading...'
-                     .format(cache_file))
-            return load_cache(cache_file)
+        log.info('Parsing new and changed files with %s job(s)', self._jobs)
+
+        for file, file_nodules, failed in \
+                map_parallel(parse_annotations_file,
+                             cache.refresh(files),
+                             self._jobs):
+            log.info('Parsed file %s: %s', file_counter, file)
+            file_counter += 1
+            cache.store(file, file_nodules, failed)
+
+            if not failed:
+                log.info('File %s has been parsed successfully', file)
 
         nodules = {}
-        files = list_files(self._annotations_path, xml_ext)
-        error_files = []
-        file_counter = 1
 
-        for file in files:
-            try:
-                log.info('Parsing file {} of {}: {}'
-                         .format(file_counter, len(files), file))
-                with open(file) as f:
-                    xml_text = f.read()
-                    parse_nodules(xml_text, nodules)
-                    log.info('File {} has been parsed successfully'
-                             .format(file))
-            except ValueError:
-                error_files.append(file)
-                log.error('Can\'t load annotations from file {}'
-                          .format(file), exc_info=True)
-            finally:
-                file_counter += 1
-
-        log.info('These {} files has not been loaded: \n{}'
-                 .format(len(error_files), '\n'.join(error_files)))
-        log.info('{} nodule annotations with {} slices loaded totally'
-                 .format(len(nodules),
-                         sum([len(n.slices) for n in
-                              nodules.values()])))
-
-        log.info('Creating annotations cache: {}'.format(cache_file))
-        create_cache(cache_file, list(nodules.values()), log)
+        for file, file_nodules in cache.entries():
+            merge_nodules(nodules, file_nodules)
+
+        error_files = cache.error_files()
+
+        log.info('These %s files has not been loaded: \n%s', len(error_files),
+                 '\n'.join(error_files))
+        log.info('%s nodule annotations with %s slices loaded totally',
+                 len(nodules),
+                 sum([len(n.slices) for n in nodules.values()]))
+
+        cache.save()
 
         return list(nodules.values())
@@ -0,0 +1,218 @@
+# coding=utf-8
+from collections import namedtuple
+from struct import error as struct_error
+from struct import unpack_from
+
+# Metadata scan reads a few tags of every file. Instead of parsing
+# the whole header with the dicom library, only a bounded prefix of
+# the file is read and elements are skipped by their length until the
+# needed tags are found. Files the scan can't resolve (no preamble,
+# big endian or deflated data, needed tags beyond the prefix) are
+# read with the dicom library.
+header_prefix_size = 16384
+preamble_size = 128
+dicom_prefix = b'DICM'
+undefined_length = 0xFFFFFFFF
+item_tag_group = 0xFFFE
+item_delimiter = 0xFFFEE00D
+sequence_delimiter = 0xFFFEE0DD
+pixel_data = 0x7FE00010
+transfer_syntax_uid = 0x00020010
+last_meta_tag = 0x0002FFFF
+implicit_little_endian = '1.2.840.10008.1.2'
+big_endian = '1.2.840.10008.1.2.2'
+deflated = '1.2.840.10008.1.2.1.99'
+long_vrs = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV',
+            b'UC', b'UN', b'UR', b'UT', b'UV'}
+
+header_tags = {
+    0x00080018: 'image_uid',
+    0x00100020: 'patient',
+    0x0020000D: 'study',
+    0x0020000E: 'series',
+    0x00200032: 'position',
+    0x00201041: 'location',
+    0x00281052: 'intercept',
+    0x00281053: 'slope'
+}
+last_header_tag = max(header_tags)
+
+DicomHeader = namedtuple('DicomHeader',
+                         'image_uid study series patient z slope intercept')
+
+
+class IncompleteHeader(Exception):
+    pass
+
+
+def _element_header(data, position, explicit):
+    # returns tag, VR, length and position of the value
+    group, element = unpack_from('<HH', data, position)
+    tag = group << 16 | element
+
+    if group == item_tag_group or not explicit:
+        # items and delimiters have no VR
+        return tag, None, unpack_from('<I', data, position + 4)[0], \
+            position + 8
+
+    vr = bytes(data[position + 4:position + 6])
+
+    if not (vr.isalpha() and vr.isupper()):
+        # implicit VR data set declared as explicit VR
+        raise IncompleteHeader()
+
+    if vr in long_vrs:
+        return tag, vr, unpack_from('<I', data, position + 8)[0], \
+            position + 12
+
+    return tag, vr, unpack_from('<H', data, position + 6)[0], position + 8
+
+
+def _skip_undefined(data, position, explicit):
+    # returns the position after the delimiter of a sequence
+    # or an item of undefined length
+    while True:
+        tag, vr, length, position = _element_header(data, position,
+                                                    explicit)
+
+        if tag == item_delimiter or tag == sequence_delimiter:
+            return position
+
+        if length == undefined_length:
+            # UN of undefined length is encoded as implicit VR
+            position = _skip_undefined(data, position,
+                                       explicit and vr != b'UN')
+        else:
+            position += length
+
+
+def _text(value):
+    return bytes(value).decode('ascii', 'replace').strip(' \x00')
+
+
+def _scan_elements(data, position, explicit, tags, last_tag):
+    # returns the values of the tags and the position
+    # of the first element after the last tag
+    values = {}
+
+    try:
+        while True:
+            tag, vr, length, value_position = _element_header(data,
+                                                              position,
+                                                              explicit)
+
+            if tag > last_tag or tag == pixel_data:
+                return values, position
+
+            if length == undefined_length:
+                position = _skip_undefined(data, value_position,
+                                           explicit and vr != b'UN')
+                continue
+
+            position = value_position + length
+
+            if position > len(data):
+                raise IncompleteHeader()
+
+            if tag in tags:
+                values[tags[tag]] = _text(data[value_position:position])
+    except struct_error:
+        raise IncompleteHeader()
+
+
+def scan_header(data):
+    # values of the header tags, raises IncompleteHeader
+    # if the prefix is not enough to find them
+    if bytes(data[preamble_size:preamble_size + 4]) != dicom_prefix:
+        raise IncompleteHeader()
+
+    # file meta information is always explicit VR little endian,
+    # the data set starts after its last element
+    meta, position = _scan_elements(data, preamble_size + 4, True,
+                                    {transfer_syntax_uid: 'syntax'},
+                                    last_meta_tag)
+    syntax = meta.get('syntax')
+
+    if syntax is None or syntax in (big_endian, deflated):
+        raise IncompleteHeader()
+
+    return _scan_elements(data, position,
+                          syntax != implicit_little_endian,
+                          header_tags, last_header_tag)[0]
+
+
+def _number(value):
+    return float(value) if value else None
+
+
+def _header(values):
+    position = values.get('position')
+    position = position.split('\\') if position else []
+
+    if len(position) == 3:
+        z = float(position[2])
+    else:
+        z = _number(values.get('location'))
+
+    slope = _number(values.get('slope'))
+    intercept = _number(values.get('intercept'))
+
+    return DicomHeader(values.get('image_uid'),
+                       values.get('study'),
+                       values.get('series'),
+                       values.get('patient'),
+                       z,
+                       1.0 if slope is None else slope,
+                       0.0 if intercept is None else intercept)
+
+
+def image_position(ds):
+    position = ds.get('ImagePositionPatient')
+
+    if position:
+        return tuple([float(p) for p in position])
+
+    location = ds.get('SliceLocation')
+
+    if location is None:
+        raise ValueError('Neither ImagePositionPatient nor '
+                         'SliceLocation is present in dicom file!')
+
+    return 0.0, 0.0, float(location)
+
+
+def read_header_full(file_path):
+    from dicom import read_file
+    ds = read_file(file_path, stop_before_pixels=True)
+    values = dict((name, ds.get(keyword)) for name, keyword in
+                  (('image_uid', 'SOPInstanceUID'),
+                   ('study', 'StudyInstanceUID'),
+                   ('series', 'SeriesInstanceUID'),
+                   ('patient', 'PatientID'),
+                   ('location', 'SliceLocation'),
+                   ('intercept', 'RescaleIntercept'),
+                   ('slope', 'RescaleSlope')))
+    values = dict((k, None if v is None else str(v).strip(' \x00'))
+                  for k, v in values.items())
+    position = ds.get('ImagePositionPatient')
+
+    if position:
+        values['position'] = '\\'.join([str(p) for p in position])
+
+    return _header(values)
+
+
+def read_header(file_path):
+    # returns the header and whether the prefix scan has resolved it
+    with open(file_path, 'rb') as f:
+        data = f.read(header_prefix_size)
+
+    try:
+        header = _header(scan_header(memoryview(data)))
+
+        if header.image_uid and header.study and header.series:
+            return header, True
+    except (IncompleteHeader, ValueError):
+        pass
+
+    return read_header_full(file_path), False
@@ -1,109 +1,165 @@
 # coding=utf-8
-from os import walk
-from os.path import isfile
+from collections import namedtuple
+from logging import DEBUG
+from os.path import basename
 from os.path import join
+from sys import intern
+from time import time
 
-from PIL import Image
-from dicom import read_file
-from matplotlib.path import Path
-from numpy import array
-from numpy import ceil
-from numpy import mgrid
-from numpy import vstack
-from numpy.ma import masked_array
-
+from Instrumentation import instrumentation
 from LoggerUtils import LoggerUtils
-from Utils import create_cache
-from Utils import load_cache
+from ManifestCache import ManifestCache
+from Utils import chunks
+from Utils import map_parallel
+from Utils import scan_files
+from extract.DicomHeaderReader import read_header
+from extract.Hounsfield import lung_window
+from extract.Hounsfield import pixel_view
+from extract.Hounsfield import rescale_parameters
+from extract.Hounsfield import to_gray
+from extract.ImageWriter import ImageWriter
 
 dic_ext = '.dcm'
 diagnosis_unknown = '0'
 log = LoggerUtils.get_logger('DicomLoader')
 cache_file_name = 'dicom.cache'
+files_per_task = 256
+# version of the cached headers format
+headers_version = 2
+
+DicomImage = namedtuple('DicomImage', 'path patient z slope intercept')
 
 unclassified_patients = set()
 total = set()
 
 
-def extract_image(dicom_path,
-                  nodule,
-                  nodule_slice,
-                  export_all_images,
-                  export_full_images,
-                  diagnosis,
-                  output_path):
-    try:
-        log.debug('Loading dicom file {}'.format(dicom_path))
-        ds = read_file(dicom_path)
-        patient = ds['0010', '0020'].value
-
-        if patient not in diagnosis:
-            if patient not in unclassified_patients:
-                unclassified_patients.add(patient)
-                log.warn('Diagnosis not found for patient {}'
-                         .format(patient))
-            if export_all_images:
-                nodule.malignancy = diagnosis_unknown
-            else:
-                log.debug('Skip image due to no diagnosis '
-                          'found for this patient')
-                return False
+def patient_malignancy(patient, diagnosis, export_all_images):
+    # returns None if images of the patient must be skipped
+    if patient not in diagnosis:
+        if patient not in unclassified_patients:
+            unclassified_patients.add(patient)
+            log.warn('Diagnosis not found for patient %s', patient)
+        if export_all_images:
+            return diagnosis_unknown
         else:
-            if diagnosis[patient] != diagnosis_unknown \
-                    or export_all_images:
-                nodule.malignancy = diagnosis[patient]
-            else:
-                log.debug('Skip image due to unknown '
-                          'diagnosis of this patient')
-                return False
-        image = Image \
-            .fromarray(ds.pixel_array.astype('int16')) \
-            .convert('I;16')
-        cropped = Image.fromarray(contour(image, nodule_slice), 'I;16')
-
-        if cropped.height is not 0 and cropped.width is not 0:
-            if export_full_images:
-                full_path = join(output_path, 'full')
-                full_file = original_file_name(full_path,
-                                               nodule,
-                                               nodule_slice)
-                image.convert('L').save(full_file)
-            slice_file = slice_image_name(output_path,
-                                          nodule,
-                                          nodule_slice)
-            cropped.convert('L').save(slice_file)
-            return True
+            log.debug('Skip image due to no diagnosis '
+                      'found for this patient')
+            return None
+    else:
+        if diagnosis[patient] != diagnosis_unknown \
+                or export_all_images:
+            return diagnosis[patient]
         else:
-            log.error('Too small contour for slice {}!'
-                      .format(nodule_slice))
-            return False
-    except ValueError:
-        log.error('Can\'t extract slice image {} from file {}'
-                  .format(nodule, dicom_path), exc_info=True)
-        return False
+            log.debug('Skip image due to unknown '
+                      'diagnosis of this patient')
+            return None
+
+
+def extract_slices(dicom_path,
+                   nodule_slices,
+                   export_all_images,
+                   export_full_images,
+                   diagnosis,
+                   output_path,
+                   export_packed=False,
+                   window=lung_window,
+                   writer=None):
+    # all (nodule, slice) pairs share the same image, so it is
+    # decoded once and every nodule is cropped from that buffer.
+    # Packed crops are returned instead of being saved as files,
+    # files are written by the writer and every extracted slice
+    # comes with the futures of its writes.
+    from dicom import read_file
+
+    if writer is None:
+        writer = ImageWriter(0)
 
+    try:
+        if log.isEnabledFor(DEBUG):
+            log.debug('Loading dicom file %s', dicom_path)
+
+        with instrumentation.timer('dicom.decode_seconds'):
+            ds = read_file(dicom_path)
+            malignancy = patient_malignancy(ds['0010', '0020'].value,
+                                            diagnosis,
+                                            export_all_images)
+
+            if malignancy is None:
+                instrumentation.count('slices.skipped_no_diagnosis',
+                                      len(nodule_slices))
+                return False, []
+
+            pixels = pixel_view(ds)
+            slope, intercept = rescale_parameters(ds)
+    except ValueError:
+        log.error('Can\'t load image from file %s', dicom_path,
+                  exc_info=True)
+        instrumentation.count('slices.skipped_unreadable',
+                              len(nodule_slices))
+        return False, []
+
+    instrumentation.count('dicom.decodes')
+
+    full_image = None
+    extracted = []
+
+    for nodule, nodule_slice in nodule_slices:
+        nodule.malignancy = malignancy
+
+        try:
+            cropped = contour(pixels, nodule_slice, slope, intercept,
+                              window)
+
+            if cropped.size != 0:
+                writes = []
+
+                if export_full_images:
+                    if full_image is None:
+                        full_image = to_gray(pixels, slope, intercept,
+                                             window)
+                    full_path = join(output_path, 'full')
+                    full_file = original_file_name(full_path,
+                                                   nodule,
+                                                   nodule_slice)
+                    writes.append(writer.submit(full_image, full_file))
+
+                if export_packed:
+                    extracted.append((nodule, nodule_slice, cropped,
+                                      writes))
+                else:
+                    slice_file = slice_image_name(output_path,
+                                                  nodule,
+                                                  nodule_slice)
+                    writes.append(writer.submit(cropped, slice_file))
+                    extracted.append((nodule, nodule_slice, None, writes))
+            else:
+                log.error('Too small contour for slice %s!', nodule_slice)
+                instrumentation.count('slices.skipped_too_small')
+        except ValueError:
+            log.error('Can\'t extract slice image %s from file %s',
+                      nodule, dicom_path, exc_info=True)
+            instrumentation.count('slices.failed')
 
-def contour(image, nodule_slice):
-    image = array(image)
-
-    xc = array([point.x for point in nodule_slice.points])
-    yc = array([point.y for point in nodule_slice.points])
-
-    xy_crop = vstack((xc, yc)).T
+    return True, extracted
 
-    nr, nc = image.shape
-    y_grid, x_grid = mgrid[:nr, :nc]
-    xy_pix = vstack((x_grid.ravel(), y_grid.ravel())).T
-    pth = Path(xy_crop, closed=True)
 
-    mask = pth.contains_points(xy_pix, radius=-1) \
-        .reshape(image.shape)
-    masked = masked_array(image, ~mask)
+def contour(pixels, nodule_slice, slope, intercept, window=lung_window):
+    # only the pixels of the crop are converted to gray levels,
+    # pixels outside of the contour are black
+    mask = nodule_slice.mask
+    x_min, y_min = nodule_slice.origin
 
-    x_min, x_max = int(xc.min()), int(ceil(xc.max()))
-    y_min, y_max = int(yc.min()), int(ceil(yc.max()))
+    # the crop excludes the last row and column of the contour
+    nr, nc = pixels.shape
+    y_start, x_start = max(y_min, 0), max(x_min, 0)
+    y_stop = max(min(y_min + mask.shape[0] - 1, nr), y_start)
+    x_stop = max(min(x_min + mask.shape[1] - 1, nc), x_start)
 
-    return masked[y_min:y_max, x_min:x_max].filled(fill_value=0)
+    gray = to_gray(pixels[y_start:y_stop, x_start:x_stop],
+                   slope, intercept, window)
+    gray[~mask[y_start - y_min:y_stop - y_min,
+               x_start - x_min:x_stop - x_min]] = 0
+    return gray
 
 
 def original_file_name(base_dir, nodule, nodule_slice):
@@ -124,25 +180,57 @@ def slice_image_name(base_dir, nodule, nodule_slice):
                 nodule.malignancy + '.png')
 
 
-def parse_dicom_file(file_path, study_data):
-    ds = read_file(file_path,
-                   stop_before_pixels=True)
-    image_uid = ds["0008", "0018"].value
-    check_initialized(image_uid, 'image_uid')
-    study = ds["0020", "000d"].value
-    check_initialized(study, 'study_id')
-    series = ds["0020", "000e"].value
-    check_initialized(series, 'series_id')
-    series_data = study_data.get(study, {})
-    image_data = series_data.get(series, {})
+def parse_dicom_file(file_path):
+    # returns the header and whether it has been read
+    # without the full dicom reader
+    header, fast = read_header(file_path)
+    check_initialized(header.image_uid, 'image_uid')
+    check_initialized(header.study, 'study_id')
+    check_initialized(header.series, 'series_id')
+    # the same study, series and patient ids are shared by lots of
+    # files, interning lets the cache pickle store them only once
+    return (intern(header.study),
+            intern(header.series),
+            header.image_uid,
+            intern(header.patient or ''),
+            header.z,
+            header.slope,
+            header.intercept), fast
+
+
+def parse_dicom_files(file_paths):
+    headers = []
+    error_files = []
+    full_reads = 0
+
+    for file_path in file_paths:
+        try:
+            if log.isEnabledFor(DEBUG):
+                log.debug('Found dicom file %s, loading', file_path)
+
+            with instrumentation.timer('dicom.header_seconds'):
+                header, fast = parse_dicom_file(file_path)
+
+            headers.append((file_path, header))
+            full_reads += not fast
+        except ValueError:
+            error_files.append(file_path)
+            log.error('Can\'t load dicom file %s', file_path,
+                      exc_info=True)
+
+    return headers, error_files, full_reads
+
+
+def add_image(study_data, file_path, header):
+    study, series, image_uid, patient, z, slope, intercept = header
+    image_data = study_data.setdefault(study, {}).setdefault(series, {})
 
     if image_uid in image_data:
-        log.warn('Found duplicate image_uid in files: {}; {}'
-                 .format(image_data[image_uid], file_path))
+        log.warn('Found duplicate image_uid in files: %s; %s',
+                 image_data[image_uid].path, file_path)
 
-    image_data[image_uid] = file_path
-    series_data[series] = image_data
-    study_data[study] = series_data
+    image_data[image_uid] = DicomImage(file_path, patient, z,
+                                       slope, intercept)
 
 
 def check_initialized(value, attribute):
@@ -152,47 +240,63 @@ def check_initialized(value, attribute):
 
 
 class DicomLoader(object):
-    def __init__(self, dicom_path):
-        log.info('Dicoms directory: {}'.format(dicom_path))
+    def __init__(self, dicom_path, jobs=1):
+        log.info('Dicoms directory: %s', dicom_path)
         self._dicom_path = dicom_path
+        self._jobs = jobs
 
     def load_dicoms_metadata(self):
-        cache_file = join(self._dicom_path, cache_file_name)
-
-        if isfile(cache_file):
-            log.info('Found cache file with dicom metadata, '
-                     'delete it to reload: {}. Loading...'
-                     .format(cache_file))
-            return load_cache(cache_file)
+        cache = ManifestCache(join(self._dicom_path, cache_file_name),
+                              log,
+                              headers_version)
+        cache.load()
+
+        # changed files are parsed chunk by chunk while
+        # the directory tree is still being listed
+        files = scan_files(self._dicom_path, dic_ext)
+        tasks = chunks(cache.refresh(files), files_per_task)
+        task_counter = 1
+        total_loaded = 0
+        total_full_reads = 0
+        start = time()
+
+        log.info('Loading new and changed dicom files with %s job(s)',
+                 self._jobs)
+
+        for headers, error_files, full_reads in \
+                map_parallel(parse_dicom_files, tasks, self._jobs):
+            log.debug('Loaded dicom files chunk %s', task_counter)
+            task_counter += 1
+            total_loaded += len(headers) + len(error_files)
+            total_full_reads += full_reads
+
+            for file_path, header in headers:
+                cache.store(file_path, header)
+            for file_path in error_files:
+                cache.store(file_path, None, failed=True)
+
+        instrumentation.count('dicom.header_full_reads', total_full_reads)
+
+        if total_loaded:
+            elapsed = time() - start
+            log.info('Scanned %s dicom headers in %.2f s, %.1f files/s, '
+                     '%s of them with the full dicom reader', total_loaded,
+                     elapsed, total_loaded / max(elapsed, 1e-6),
+                     total_full_reads)
 
         study_data = {}
-        error_files = []
-        file_counter = 1
-
-        for dir_name, sub_dirs, file_list in walk(self._dicom_path):
-            for file in file_list:
-                if file.lower().endswith(dic_ext):
-                    file_path = join(dir_name, file)
-
-                    try:
-                        log.debug('Found dicom file #{} {}, loading'
-                                  .format(file_counter, file_path))
-                        parse_dicom_file(file_path, study_data)
-                    except ValueError:
-                        error_files.append(file)
-                        log.error('Can\'t load dicom file {} '
-                                  .format(file_path), exc_info=True)
-                    finally:
-                        file_counter += 1
-
-        log.info('These {} files has not been loaded: \n{}'
-                 .format(len(error_files), '\n'.join(error_files)))
-        log.info('{} images found totally'
-                 .format(sum([len(f) for l in study_data.values()
-                              for f in l.values()])))
-
-        log.info('Creating dicom metadata cache: {}'
-                 .format(cache_file))
-        create_cache(cache_file, study_data, log)
+
+        for file_path, header in cache.entries():
+            add_image(study_data, file_path, header)
+
+        error_files = [basename(f) for f in cache.error_files()]
+
+        log.info('These %s files has not been loaded: \n%s', len(error_files),
+                 '\n'.join(error_files))
+        log.info('%s images found totally',
+                 sum([len(f) for l in study_data.values()
+                      for f in l.values()]))
+
+        cache.save()
 
         return study_data
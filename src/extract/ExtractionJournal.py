@@ -0,0 +1,106 @@
+# coding=utf-8
+from hashlib import sha1
+from os import fsync
+from os.path import isfile
+from os.path import join
+from pickle import HIGHEST_PROTOCOL
+from pickle import dump
+from pickle import load
+
+from LoggerUtils import LoggerUtils
+
+log = LoggerUtils.get_logger('ExtractionJournal')
+journal_version = 1
+journal_file_name = 'extraction.journal'
+
+
+def unit_key(nodule, nodule_slice):
+    # slice uids are random, so a unit is identified by its contents
+    digest = sha1(repr(nodule.key + (nodule_slice.image_uid,
+                                     nodule_slice.z_pos))
+                  .encode('utf-8'))
+    digest.update(nodule_slice.vertices.tobytes())
+    return digest.hexdigest()
+
+
+class ExtractionJournal(object):
+    # Append only log of extracted (nodule, slice) units. Every record
+    # is a separate pickle, so a journal cut by a crash is readable up
+    # to its last complete record.
+    def __init__(self, output_path, settings):
+        self._file = join(output_path, journal_file_name)
+        self._header = journal_version, settings
+        # unit key -> (dicom signature, nodule key, malignancy,
+        #              slice, pixels)
+        self._records = {}
+        self._stream = None
+
+    def __len__(self):
+        return len(self._records)
+
+    def open(self):
+        valid_length = self._read() if isfile(self._file) else 0
+
+        if valid_length:
+            self._stream = open(self._file, 'r+b')
+            self._stream.seek(valid_length)
+            self._stream.truncate()
+        else:
+            self._stream = open(self._file, 'wb')
+            dump(self._header, self._stream, HIGHEST_PROTOCOL)
+            self.flush()
+
+        log.info('Journal {} has {} completed slices'
+                 .format(self._file, len(self._records)))
+
+    def _read(self):
+        # returns the length of the journal part which can be kept
+        valid_length = 0
+
+        with open(self._file, 'rb') as f:
+            try:
+                if load(f) != self._header:
+                    log.info('Extraction settings have changed, '
+                             'journal {} is restarted'.format(self._file))
+                    return 0
+
+                valid_length = f.tell()
+
+                while True:
+                    record = load(f)
+                    self._records[record[0]] = record[1:]
+                    valid_length = f.tell()
+            except EOFError:
+                pass
+            except Exception:
+                log.warn('Journal {} is damaged after {} records, the '
+                         'rest of it is dropped'
+                         .format(self._file, len(self._records)),
+                         exc_info=True)
+
+        return valid_length
+
+    def completed(self, nodule, nodule_slice, signature):
+        # record of the unit if it has been extracted from the
+        # same dicom file
+        record = self._records.get(unit_key(nodule, nodule_slice))
+
+        if record is None or record[0] != signature:
+            return None
+
+        return record
+
+    def record(self, nodule, nodule_slice, signature, pixels):
+        key = unit_key(nodule, nodule_slice)
+        record = signature, nodule.key, nodule.malignancy, \
+            nodule_slice, pixels
+        self._records[key] = record
+        dump((key,) + record, self._stream, HIGHEST_PROTOCOL)
+
+    def flush(self):
+        self._stream.flush()
+        fsync(self._stream.fileno())
+
+    def close(self):
+        self.flush()
+        self._stream.close()
@@ -0,0 +1,82 @@
+# coding=utf-8
+from numpy import clip
+from numpy import frombuffer
+from numpy import iinfo
+from numpy import rint
+
+hounsfield_type = 'int16'
+hounsfield_min = iinfo(hounsfield_type).min
+hounsfield_max = iinfo(hounsfield_type).max
+# level and width of the Hounsfield window
+lung_window = (-600.0, 1500.0)
+# implicit and explicit VR little endian
+uncompressed_syntaxes = ('1.2.840.10008.1.2', '1.2.840.10008.1.2.1')
+
+
+def pixel_view(ds):
+    # uncompressed 16 bit pixels are used in place of the pixel data,
+    # anything else is decoded by the dicom library
+    file_meta = getattr(ds, 'file_meta', None)
+    syntax = file_meta.get('TransferSyntaxUID') \
+        if file_meta is not None else None
+    bits_stored = ds.get('BitsStored', 16)
+
+    if syntax in uncompressed_syntaxes and \
+            ds.get('BitsAllocated') == 16 and \
+            ds.get('SamplesPerPixel', 1) == 1 and \
+            ds.get('HighBit', bits_stored - 1) == bits_stored - 1:
+        rows, columns = int(ds.Rows), int(ds.Columns)
+        pixels = frombuffer(ds.PixelData,
+                            dtype='<i2' if ds.PixelRepresentation
+                            else '<u2',
+                            count=rows * columns).reshape(rows, columns)
+
+        if bits_stored == 16:
+            return pixels
+
+        # bits above the stored ones are dropped like the dicom
+        # library does, signed values are sign extended
+        unused = 16 - bits_stored
+
+        if ds.PixelRepresentation:
+            return (pixels << unused) >> unused
+
+        return pixels & ((1 << bits_stored) - 1)
+
+    return ds.pixel_array
+
+
+def rescale_parameters(ds):
+    # CT pixels are stored values, Hounsfield units are
+    # value * RescaleSlope + RescaleIntercept
+    slope = ds.get('RescaleSlope')
+    intercept = ds.get('RescaleIntercept')
+    return 1.0 if slope is None else float(slope), \
+        0.0 if intercept is None else float(intercept)
+
+
+def to_gray(pixels, slope, intercept, window=lung_window):
+    # rescale and window are folded into one affine transform of
+    # the stored values, applied in place on a float32 copy
+    level, width = window
+    scale = 255.0 / width
+    gray = pixels.astype('float32')
+    gray *= slope * scale
+    # 0.5 makes the truncation below round to the nearest level
+    gray += (intercept - level + width / 2) * scale + 0.5
+    clip(gray, 0, 255, out=gray)
+    return gray.astype('uint8')
+
+
+def to_hounsfield(pixels, slope, intercept, out=None):
+    hounsfield = pixels.astype('float32')
+    hounsfield *= slope
+    hounsfield += intercept
+    rint(hounsfield, out=hounsfield)
+    clip(hounsfield, hounsfield_min, hounsfield_max, out=hounsfield)
+
+    if out is None:
+        return hounsfield.astype(hounsfield_type)
+
+    out[...] = hounsfield
+    return out
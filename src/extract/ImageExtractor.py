@@ -1,20 +1,43 @@
 # coding=utf-8
+from collections import OrderedDict
+from functools import partial
 from os import makedirs
+from os.path import isdir
+from os.path import isfile
 from os.path import join
+from shutil import rmtree
 
+from Instrumentation import instrumentation
 from LoggerUtils import LoggerUtils
 from Utils import create_cache
+from Utils import file_signature
+from Utils import map_parallel
+from Utils import source_fingerprint
+from extract.AnnotationStore import write_store
 from extract.AnnotationsLoader import AnnotationsLoader
 from extract.DicomLoader import DicomLoader
-from extract.DicomLoader import extract_image
+from extract.DicomLoader import extract_slices
+from extract.DicomLoader import original_file_name
+from extract.DicomLoader import patient_malignancy
+from extract.DicomLoader import slice_image_name
+from extract.DicomLoader import unclassified_patients
+from extract.ExtractionJournal import ExtractionJournal
+from extract.Hounsfield import lung_window
+from extract.ImageStore import ImageStoreWriter
+from extract.ImageWriter import ImageWriter
+from extract.MetadataIndex import index_file_name
+from extract.MetadataIndex import write_index
+from extract.VolumeExporter import export_volumes
 from extract.PatientDiagnosisLoader import PatientDiagnosisLoader
 
 log = LoggerUtils.get_logger('ImageExtractor')
 slices_cache_name = 'extracted_slices.cache'
+slices_store_name = 'extracted_slices.store'
+images_store_name = 'nodule_images.store'
 
 
-def read_dicoms_metadata(path):
-    dicom_loader = DicomLoader(path)
+def read_dicoms_metadata(path, jobs=1):
+    dicom_loader = DicomLoader(path, jobs)
     metadata = dicom_loader.load_dicoms_metadata()
     return metadata
 
@@ -25,8 +48,8 @@ def read_diagnosis(path):
     return diagnosis
 
 
-def read_annotations(path):
-    annotations_loader = AnnotationsLoader(path)
+def read_annotations(path, jobs=1):
+    annotations_loader = AnnotationsLoader(path, jobs)
     nodules = annotations_loader.load_nodules_annotations()
     return nodules
 
@@ -36,13 +59,29 @@ def extract_images(dicoms_path,
                    diagnosis_path,
                    output_path,
                    export_all_images,
-                   export_full_images):
+                   export_full_images,
+                   jobs=1,
+                   export_packed=False,
+                   export_series_volumes=False,
+                   window=lung_window,
+                   resume=False,
+                   writer_threads=2,
+                   export_index=False):
     log.info('Loading nodule annotations....')
-    nodules = read_annotations(annotations_path)
+
+    with instrumentation.stage('annotations'):
+        nodules = read_annotations(annotations_path, jobs)
+
     log.info('Loading diagnosis....')
-    diagnosis = read_diagnosis(diagnosis_path)
+
+    with instrumentation.stage('diagnosis'):
+        diagnosis = read_diagnosis(diagnosis_path)
+
     log.info('Loading dicoms metadata....')
-    metadata = read_dicoms_metadata(dicoms_path)
+
+    with instrumentation.stage('metadata'):
+        metadata = read_dicoms_metadata(dicoms_path, jobs)
+
     log.info('Dicoms metadata loaded')
 
     makedirs(output_path, exist_ok=True)
@@ -50,75 +89,305 @@ def extract_images(dicoms_path,
     if export_full_images:
         makedirs(join(output_path, 'full'), exist_ok=True)
 
-    log.info('Extracting images')
+    log.info('Grouping nodule slices by series and image')
 
-    nodule_count = 1
-    extracted_nodules = set()
+    with instrumentation.stage('grouping'):
+        series_images = group_slices_by_series(nodules, metadata)
+        # volumes are exported whatever the diagnosis is
+        series_keys = list(series_images.keys())
+        series_images = skip_undiagnosed(series_images,
+                                         metadata,
+                                         diagnosis,
+                                         export_all_images)
 
-    for nodule in nodules:
-        log.info('Processing nodule {} of {}'
-                 .format(nodule_count, len(nodules)))
-        nodule_count += 1
-        process_nodule(nodule,
-                       metadata,
-                       diagnosis,
-                       export_all_images,
-                       export_full_images,
-                       output_path,
-                       extracted_nodules)
+    nodules_by_key = dict((n.key, n) for n in nodules)
+    signatures = {}
+    completed = []
+    journal = None
+    # settings the extracted slices depend on
+    fingerprint = source_fingerprint(export_all_images,
+                                     export_full_images,
+                                     export_packed,
+                                     tuple(window),
+                                     sorted(diagnosis.items()))
 
-    log.info('{} nodule slices extracted successfully'
-             .format(sum([len(i.slices) for i in extracted_nodules])))
+    if resume:
+        journal = ExtractionJournal(output_path, fingerprint)
 
-    cache_file = join(output_path, slices_cache_name)
+        with instrumentation.stage('resume'):
+            journal.open()
+            series_images, completed = skip_completed(series_images,
+                                                      journal,
+                                                      signatures,
+                                                      output_path,
+                                                      export_full_images)
 
-    log.info('Creating cache with extracted slices info: {}'
-             .format(cache_file))
-    create_cache(cache_file, extracted_nodules, log)
+        instrumentation.count('slices.skipped_completed', len(completed))
+        log.info('%s slices have been extracted by previous runs '
+                 'and are skipped', len(completed))
 
+    image_total = sum([len(i) for i in series_images.values()])
+    slice_total = sum([len(s) for i in series_images.values()
+                       for s in i.values()])
 
-def process_nodule(nodule,
-                   metadata,
-                   diagnosis,
+    log.info('Extracting %s slices from %s images of %s series '
+             'with %s job(s), window level %s width %s', slice_total,
+             image_total, len(series_images), jobs, window[0], window[1])
+
+    series_count = 1
+    decoded_images = 0
+    decoded_slices = 0
+    extracted_nodules = {}
+    images_store_path = join(output_path, images_store_name)
+    images_store = ImageStoreWriter(images_store_path) \
+        if export_packed else None
+
+    # learning prefers a packed store, so one left over by a packed
+    # extraction would hide the png files extracted now
+    if not export_packed and isdir(images_store_path):
+        log.info('Removing packed nodule images of a previous '
+                 'extraction: %s', images_store_path)
+        rmtree(images_store_path)
+    extract = partial(extract_series,
+                      export_all_images=export_all_images,
+                      export_full_images=export_full_images,
+                      diagnosis=diagnosis,
+                      output_path=output_path,
+                      export_packed=export_packed,
+                      window=window,
+                      writer_threads=writer_threads)
+
+    for _, key, malignancy, nodule_slice, pixels in completed:
+        add_extracted(extracted_nodules, images_store,
+                      nodules_by_key[key], malignancy, nodule_slice, pixels)
+
+    with instrumentation.stage('extraction', slice_total):
+        for images, slices, extracted, unclassified in \
+                map_parallel(extract, series_images.values(), jobs):
+            log.info('Processed series %s of %s', series_count,
+                     len(series_images))
+            series_count += 1
+            decoded_images += images
+            decoded_slices += slices
+            unclassified_patients.update(unclassified)
+
+            for key, malignancy, nodule_slice, pixels in extracted:
+                # worker processes return copies, so results are
+                # mapped back onto the loaded nodules
+                nodule = nodules_by_key[key]
+                add_extracted(extracted_nodules, images_store,
+                              nodule, malignancy, nodule_slice, pixels)
+
+                if journal is not None:
+                    image = metadata[key[0]][key[1]][nodule_slice.image_uid]
+                    journal.record(nodule, nodule_slice,
+                                   signatures[image.path], pixels)
+
+            if journal is not None:
+                journal.flush()
+
+    if journal is not None:
+        journal.close()
+
+    for nodule, extracted_slices in extracted_nodules.items():
+        # update nodule with exported slices only
+        nodule.slices.clear()
+        nodule.slices.update(extracted_slices)
+
+    log.info('%s patients without diagnosis found', len(unclassified_patients))
+    log.info('%s images decoded for %s slices, %s decodes saved',
+             decoded_images, decoded_slices, decoded_slices - decoded_images)
+    extracted_total = sum([len(i.slices) for i in extracted_nodules])
+    instrumentation.count('slices.extracted', extracted_total)
+    log.info('%s nodule slices extracted successfully', extracted_total)
+
+    with instrumentation.stage('stores'):
+        if images_store is not None:
+            log.info('%s nodule images have been packed into store %s',
+                     images_store.close(), images_store_path)
+
+        cache_file = join(output_path, slices_cache_name)
+
+        log.info('Creating cache with extracted slices info: %s', cache_file)
+        create_cache(cache_file, set(extracted_nodules), log, fingerprint)
+        write_store(join(output_path, slices_store_name),
+                    extracted_nodules, fingerprint)
+
+    if export_index:
+        with instrumentation.stage('index'):
+            write_index(join(output_path, index_file_name), metadata,
+                        extracted_nodules, diagnosis)
+
+    if export_series_volumes:
+        with instrumentation.stage('volumes', len(series_keys)):
+            export_volumes(series_keys, metadata, output_path, jobs)
+
+
+def extract_series(images,
                    export_all_images,
                    export_full_images,
+                   diagnosis,
+                   output_path,
+                   export_packed=False,
+                   window=lung_window,
+                   writer_threads=0):
+    decoded_images = 0
+    decoded_slices = 0
+    written = []
+    extracted = []
+
+    # images are decoded while the previous ones are being written
+    with ImageWriter(writer_threads) as writer:
+        for dicom_path, nodule_slices in images.items():
+            decoded, image_extracted = extract_slices(dicom_path,
+                                                      nodule_slices,
+                                                      export_all_images,
+                                                      export_full_images,
+                                                      diagnosis,
+                                                      output_path,
+                                                      export_packed,
+                                                      window,
+                                                      writer)
+
+            if decoded:
+                decoded_images += 1
+                decoded_slices += len(nodule_slices)
+
+            written.extend(image_extracted)
+
+    # all writes are done once the writer is closed, slices
+    # with failed writes are not extracted
+    for nodule, nodule_slice, pixels, writes in written:
+        errors = [w.exception() for w in writes
+                  if w.exception() is not None]
+
+        if errors:
+            log.error('Can\'t write images of slice %s of nodule %s: %s',
+                      nodule_slice.uid, nodule, errors[0])
+            instrumentation.count('slices.write_failed')
+        else:
+            extracted.append((nodule.key, nodule.malignancy,
+                              nodule_slice, pixels))
+
+    return decoded_images, decoded_slices, extracted, \
+        set(unclassified_patients)
+
+
+def add_extracted(extracted_nodules,
+                  images_store,
+                  nodule,
+                  malignancy,
+                  nodule_slice,
+                  pixels):
+    nodule.malignancy = malignancy
+    extracted_nodules.setdefault(nodule, set()).add(nodule_slice)
+
+    if images_store is not None:
+        images_store.add(nodule, nodule_slice, pixels)
+
+
+def skip_completed(series_images,
+                   journal,
+                   signatures,
                    output_path,
-                   extracted_nodules):
-    study = nodule.study
-    series = nodule.series
-
-    if study not in metadata:
-        log.error('No dicom file found for nodule '
-                  'with study id {}!'.format(study))
-    elif series not in metadata[study]:
-        log.error('No dicom file found for nodule '
-                  'with series id {}!'.format(series))
-    else:
-        slice_count = 1
-        extracted_slices = set()
-
-        for nodule_slice in nodule.slices:
-            log.debug('Processing slice {} of {}'
-                      .format(slice_count, len(nodule.slices)))
-            slice_count += 1
-            image_uid = nodule_slice.image_uid
-            if image_uid not in metadata[study][series]:
-                log.error('No dicom file found for nodule '
-                          'with image id {}!'.format(image_uid))
+                   export_full_images):
+    # units of the journal are skipped if their dicom file has not
+    # changed and their images are still there
+    remaining = OrderedDict()
+    completed = []
+
+    for series_key, images in series_images.items():
+        for dicom_path, nodule_slices in images.items():
+            signature = signatures[dicom_path] = file_signature(dicom_path)
+            left = []
+
+            for nodule, nodule_slice in nodule_slices:
+                record = journal.completed(nodule, nodule_slice, signature)
+
+                if record is not None and \
+                        images_exist(record, nodule, output_path,
+                                     export_full_images):
+                    completed.append(record)
+                else:
+                    left.append((nodule, nodule_slice))
+
+            if left:
+                remaining.setdefault(series_key, OrderedDict())[
+                    dicom_path] = left
+
+    return remaining, completed
+
+
+def images_exist(record, nodule, output_path, export_full_images):
+    _, _, malignancy, nodule_slice, pixels = record
+    nodule.malignancy = malignancy
+
+    if pixels is None and not isfile(slice_image_name(output_path,
+                                                      nodule,
+                                                      nodule_slice)):
+        return False
+
+    return not export_full_images or \
+        isfile(original_file_name(join(output_path, 'full'),
+                                  nodule,
+                                  nodule_slice))
+
+
+def skip_undiagnosed(series_images, metadata, diagnosis, export_all_images):
+    # patient ids come from the metadata scan, so images of patients
+    # without a usable diagnosis are dropped before they are decoded
+    remaining = OrderedDict()
+    skipped_images = 0
+    skipped_slices = 0
+    skipped_patients = set()
+
+    for (study, series), images in series_images.items():
+        for dicom_path, nodule_slices in images.items():
+            image_uid = nodule_slices[0][1].image_uid
+            patient = metadata[study][series][image_uid].patient
+
+            if patient_malignancy(patient, diagnosis,
+                                  export_all_images) is None:
+                skipped_images += 1
+                skipped_slices += len(nodule_slices)
+                skipped_patients.add(patient)
             else:
-                dicom_path = metadata[study][series][image_uid]
-                extracted = extract_image(dicom_path,
-                                          nodule,
-                                          nodule_slice,
-                                          export_all_images,
-                                          export_full_images,
-                                          diagnosis,
-                                          output_path)
-                if extracted:
-                    extracted_slices.add(nodule_slice)
-
-        if extracted_slices:
-            # update nodule with exported slices only
-            nodule.slices.clear()
-            nodule.slices.update(extracted_slices)
-            extracted_nodules.add(nodule)
+                remaining.setdefault((study, series), OrderedDict())[
+                    dicom_path] = nodule_slices
+
+    instrumentation.count('images.skipped_no_diagnosis', skipped_images)
+    instrumentation.count('slices.skipped_no_diagnosis', skipped_slices)
+    log.info('%s slices of %s images of %s patients without a usable '
+             'diagnosis are skipped before decoding', skipped_slices,
+             skipped_images, len(skipped_patients))
+    return remaining
+
+
+def group_slices_by_series(nodules, metadata):
+    series_images = OrderedDict()
+
+    for nodule in nodules:
+        study = nodule.study
+        series = nodule.series
+
+        if study not in metadata:
+            log.error('No dicom file found for nodule '
+                      'with study id %s!', study)
+        elif series not in metadata[study]:
+            log.error('No dicom file found for nodule '
+                      'with series id %s!', series)
+        else:
+            images = series_images.setdefault((study, series),
+                                              OrderedDict())
+
+            for nodule_slice in nodule.slices:
+                image_uid = nodule_slice.image_uid
+                if image_uid not in metadata[study][series]:
+                    log.error('No dicom file found for nodule '
+                              'with image id %s!', image_uid)
+                else:
+                    dicom_path = metadata[study][series][image_uid].path
+                    images.setdefault(dicom_path, []) \
+                        .append((nodule, nodule_slice))
+
+    return series_images
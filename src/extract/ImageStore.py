@@ -0,0 +1,119 @@
+# coding=utf-8
+from os.path import getsize
+from os.path import join
+
+from numpy import array
+from numpy import ascontiguousarray
+from numpy import frombuffer
+from numpy import memmap
+from numpy import zeros
+
+from Utils import encode_strings
+from Utils import group_maxima
+from Utils import load_table
+from Utils import new_directory
+from Utils import replace_directory
+from Utils import save_table
+
+store_version = 1
+buffer_file_name = 'images.bin'
+
+# Crops are appended one after another to a single uint8 buffer,
+# every row of the index tells where a crop starts and its shape
+image_columns = ('offset', 'height', 'width', 'nodule', 'study', 'series',
+                 'nodule_id', 'uid', 'z_pos', 'area', 'malignancy')
+
+
+class ImageStoreWriter(object):
+    def __init__(self, path):
+        self._path = path
+        self._temp_path = path + '.tmp'
+        new_directory(self._temp_path)
+        self._buffer = open(join(self._temp_path, buffer_file_name), 'wb')
+        self._offset = 0
+        self._nodules = {}
+        self._rows = []
+
+    def add(self, nodule, nodule_slice, pixels):
+        pixels = ascontiguousarray(pixels, dtype='uint8')
+        self._buffer.write(pixels.tobytes())
+        self._rows.append((self._offset,
+                           pixels.shape[0],
+                           pixels.shape[1],
+                           self._nodules.setdefault(nodule.key,
+                                                    len(self._nodules)),
+                           nodule.study,
+                           nodule.series,
+                           nodule.nodule_id,
+                           bytes.fromhex(nodule_slice.uid),
+                           nodule_slice.z_pos,
+                           nodule_slice.area,
+                           int(nodule.malignancy)))
+        self._offset += pixels.size
+
+    def close(self):
+        self._buffer.close()
+        columns = dict(zip(image_columns, zip(*self._rows))) \
+            if self._rows else dict((c, ()) for c in image_columns)
+
+        save_table(self._temp_path, 'images', {
+            'offset': array(columns['offset'], dtype='int64'),
+            'height': array(columns['height'], dtype='int32'),
+            'width': array(columns['width'], dtype='int32'),
+            'nodule': array(columns['nodule'], dtype='int32'),
+            'study': encode_strings(columns['study']),
+            'series': encode_strings(columns['series']),
+            'nodule_id': encode_strings(columns['nodule_id']),
+            'uid': frombuffer(b''.join(columns['uid']),
+                              dtype='uint8').reshape(-1, 16),
+            'z_pos': array(columns['z_pos'], dtype='float64'),
+            'area': array(columns['area'], dtype='int32'),
+            'malignancy': array(columns['malignancy'], dtype='int8')
+        })
+        save_table(self._temp_path, 'store',
+                   {'version': array([store_version])})
+        replace_directory(self._temp_path, self._path)
+
+        return len(self._rows)
+
+
+class ImageStore(object):
+    def __init__(self, path):
+        version = load_table(path, 'store', ('version',))['version']
+
+        if version.shape != (1,) or version[0] != store_version:
+            raise ValueError('Image store {} has an unsupported version'
+                             .format(path))
+
+        self._index = load_table(path, 'images', image_columns)
+        buffer_file = join(path, buffer_file_name)
+
+        # an empty file can't be memory mapped
+        self._buffer = memmap(buffer_file, dtype='uint8', mode='r') \
+            if getsize(buffer_file) else zeros(0, dtype='uint8')
+
+    def __len__(self):
+        return len(self._index['offset'])
+
+    @property
+    def index(self):
+        return self._index
+
+    def image(self, row):
+        # a view of the mapped buffer, nothing is copied
+        offset = int(self._index['offset'][row])
+        height = int(self._index['height'][row])
+        width = int(self._index['width'][row])
+        return self._buffer[offset:offset + height * width] \
+            .reshape(height, width)
+
+    def biggest_slices(self, min_area=None):
+        # rows of the biggest slice of every nodule
+        area = self._index['area']
+        biggest = group_maxima(self._index['nodule'], area)
+
+        if min_area is not None:
+            biggest = biggest[area[biggest] > min_area]
+
+        biggest.sort()
+        return biggest
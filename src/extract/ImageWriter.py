@@ -0,0 +1,57 @@
+# coding=utf-8
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+
+max_pending_images = 64
+
+
+def write_image(pixels, file):
+    # png compression runs outside of the GIL
+    from PIL import Image
+    Image.fromarray(pixels, 'L').save(file)
+    return file
+
+
+class ImageWriter(object):
+    # Encodes and writes gray images in background threads. At most
+    # max_pending images wait to be written and submit blocks until
+    # one of them is done, so memory stays bounded when writing is
+    # slower than decoding. Without threads images are written at once.
+    def __init__(self, threads=2, max_pending=max_pending_images):
+        self._executor = ThreadPoolExecutor(threads) if threads > 0 \
+            else None
+        self._pending = BoundedSemaphore(max_pending)
+
+    def submit(self, pixels, file):
+        if self._executor is None:
+            future = Future()
+
+            try:
+                future.set_result(write_image(pixels, file))
+            except Exception as e:
+                future.set_exception(e)
+
+            return future
+
+        self._pending.acquire()
+
+        try:
+            future = self._executor.submit(write_image, pixels, file)
+        except Exception:
+            self._pending.release()
+            raise
+
+        future.add_done_callback(lambda _: self._pending.release())
+        return future
+
+    def close(self):
+        # waits for all submitted images
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
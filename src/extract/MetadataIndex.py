@@ -0,0 +1,209 @@
+# coding=utf-8
+from collections import OrderedDict
+from os import getpid
+from os import remove
+from os import replace
+from os.path import isfile
+from sqlite3 import connect
+from urllib.request import pathname2url
+
+from numpy import frombuffer
+
+from LoggerUtils import LoggerUtils
+from extract.AnnotationsLoader import slice_order
+from extract.Nodule import Nodule
+from extract.Slice import Slice
+from extract.Slice import vertex_type
+
+log = LoggerUtils.get_logger('MetadataIndex')
+index_version = 1
+index_file_name = 'metadata.sqlite'
+
+# Slices of a nodule are stored in the order of slice_order, so of
+# the slices with the same area the last stored one is the biggest
+# like in the annotation store. Vertices are int16 (x, y) pairs.
+index_schema = '''
+CREATE TABLE info (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE studies (
+    id INTEGER PRIMARY KEY,
+    uid TEXT NOT NULL UNIQUE,
+    patient TEXT
+);
+CREATE TABLE series (
+    id INTEGER PRIMARY KEY,
+    study INTEGER NOT NULL REFERENCES studies (id),
+    uid TEXT NOT NULL,
+    UNIQUE (study, uid)
+);
+CREATE TABLE images (
+    id INTEGER PRIMARY KEY,
+    series INTEGER NOT NULL REFERENCES series (id),
+    uid TEXT NOT NULL,
+    path TEXT NOT NULL,
+    patient TEXT,
+    z REAL,
+    slope REAL NOT NULL,
+    intercept REAL NOT NULL,
+    UNIQUE (series, uid)
+);
+CREATE TABLE nodules (
+    id INTEGER PRIMARY KEY,
+    series INTEGER NOT NULL REFERENCES series (id),
+    nodule_id TEXT NOT NULL,
+    malignancy TEXT,
+    UNIQUE (series, nodule_id)
+);
+CREATE TABLE slices (
+    id INTEGER PRIMARY KEY,
+    nodule INTEGER NOT NULL REFERENCES nodules (id),
+    image_uid TEXT NOT NULL,
+    z_pos REAL NOT NULL,
+    area INTEGER NOT NULL,
+    uid BLOB NOT NULL,
+    vertices BLOB NOT NULL
+);
+CREATE INDEX slices_area ON slices (nodule, area);
+CREATE INDEX slices_image ON slices (image_uid);
+CREATE TABLE diagnoses (
+    patient TEXT PRIMARY KEY,
+    diagnosis TEXT NOT NULL
+);
+'''
+
+nodule_query = '''
+SELECT st.uid, se.uid, n.nodule_id, n.malignancy,
+       s.image_uid, s.z_pos, s.area, s.uid, s.vertices
+FROM nodules n
+JOIN series se ON se.id = n.series
+JOIN studies st ON st.id = se.study
+JOIN slices s ON s.id = (SELECT b.id FROM slices b
+                         WHERE b.nodule = n.id
+                         ORDER BY b.area DESC, b.id DESC LIMIT 1)
+{}
+ORDER BY n.id
+'''
+
+def write_index(path, metadata, nodules, diagnosis):
+    # dicom metadata, nodules with their slices and diagnosis
+    # are written into a new database which replaces the old one
+    nodules = sorted(nodules, key=lambda n: n.key)
+    studies = OrderedDict()
+    series_ids = OrderedDict()
+
+    for study, study_series in sorted(metadata.items()):
+        patients = [i.patient for s in study_series.values()
+                    for i in s.values()]
+        studies[study] = len(studies) + 1, patients[0] if patients \
+            else None
+
+        for series in sorted(study_series):
+            series_ids[study, series] = len(series_ids) + 1
+
+    # annotated series may have no dicom files
+    for nodule in nodules:
+        if nodule.study not in studies:
+            studies[nodule.study] = len(studies) + 1, None
+        if (nodule.study, nodule.series) not in series_ids:
+            series_ids[nodule.study, nodule.series] = len(series_ids) + 1
+
+    temp_file = '{}.{}.tmp'.format(path, getpid())
+
+    if isfile(temp_file):
+        remove(temp_file)
+
+    connection = connect(temp_file)
+
+    try:
+        connection.executescript(index_schema)
+
+        with connection:
+            connection.execute('INSERT INTO info VALUES (?, ?)',
+                               ('version', str(index_version)))
+            connection.executemany(
+                'INSERT INTO studies VALUES (?, ?, ?)',
+                ((i, study, patient)
+                 for study, (i, patient) in studies.items()))
+            connection.executemany(
+                'INSERT INTO series VALUES (?, ?, ?)',
+                ((i, studies[study][0], series)
+                 for (study, series), i in series_ids.items()))
+            connection.executemany(
+                'INSERT INTO images (series, uid, path, patient, z, '
+                'slope, intercept) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                ((series_ids[study, series], image_uid) + tuple(image)
+                 for study, study_series in sorted(metadata.items())
+                 for series, images in sorted(study_series.items())
+                 for image_uid, image in sorted(images.items())))
+            connection.executemany(
+                'INSERT INTO nodules VALUES (?, ?, ?, ?)',
+                ((i + 1, series_ids[n.study, n.series], n.nodule_id,
+                  None if n.malignancy is None else str(n.malignancy))
+                 for i, n in enumerate(nodules)))
+            connection.executemany(
+                'INSERT INTO slices (nodule, image_uid, z_pos, area, uid, '
+                'vertices) VALUES (?, ?, ?, ?, ?, ?)',
+                ((i + 1, s.image_uid, s.z_pos, s.area,
+                  bytes.fromhex(s.uid), s.vertices.tobytes())
+                 for i, n in enumerate(nodules)
+                 for s in sorted(n.slices, key=slice_order)))
+            connection.executemany(
+                'INSERT INTO diagnoses VALUES (?, ?)',
+                sorted(diagnosis.items()))
+    finally:
+        connection.close()
+
+    replace(temp_file, path)
+    log.info('Metadata index of {} series and {} nodules has been '
+             'written: {}'.format(len(series_ids), len(nodules), path))
+
+
+class MetadataIndex(object):
+    def __init__(self, path):
+        # opened read only, so any number of processes can share it
+        self._connection = connect('file:{}?mode=ro'
+                                   .format(pathname2url(path)),
+                                   uri=True)
+        version = self._connection.execute(
+            'SELECT value FROM info WHERE key = ?', ('version',)) \
+            .fetchone()
+
+        if version is None or version[0] != str(index_version):
+            self._connection.close()
+            raise ValueError('Metadata index {} has an unsupported '
+                             'version'.format(path))
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def biggest_slices(self, min_area=None):
+        # nodules with their biggest slice only, the biggest one has
+        # to be greater than min_area
+        if min_area is None:
+            rows = self._connection.execute(nodule_query.format(''))
+        else:
+            rows = self._connection.execute(
+                nodule_query.format('WHERE s.area > ?'), (min_area,))
+
+        nodules = []
+
+        for study, series, nodule_id, malignancy, image_uid, z_pos, \
+                area, uid, vertices in rows:
+            nodule = Nodule(study, series, nodule_id)
+            nodule.malignancy = malignancy
+            nodule_slice = Slice.__new__(Slice)
+            nodule_slice.__setstate__((
+                image_uid, z_pos, None, area, bytes(uid),
+                frombuffer(vertices, dtype=vertex_type).reshape(-1, 2)))
+            nodule.slices.add(nodule_slice)
+            nodules.append(nodule)
+
+        return nodules
@@ -1,5 +1,8 @@
 # coding=utf-8
 class Nodule(object):
+    __slots__ = ('_study', '_series', '_nodule_id',
+                 '_malignancy', '_slices')
+
     def __init__(self, study, series, nodule_id):
         self._study = study
         self._series = series
@@ -19,6 +22,10 @@ class Nodule(object):
     def nodule_id(self):
         return self._nodule_id
 
+    @property
+    def key(self):
+        return self._study, self._series, self._nodule_id
+
     @property
     def malignancy(self):
         return self._malignancy
@@ -31,6 +38,15 @@ class Nodule(object):
     def malignancy(self, value):
         self._malignancy = value
 
+    def __setstate__(self, state):
+        # caches pickled before __slots__ keep a plain __dict__
+        # instead of the (None, slots) state
+        if isinstance(state, tuple):
+            state = state[1]
+
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def __eq__(self, other):
         if not isinstance(other, Nodule):
             return False
@@ -1,12 +1,11 @@
 # coding=utf-8
 from csv import reader
-from os.path import isfile
 from os.path import join
 
+from Instrumentation import instrumentation
 from LoggerUtils import LoggerUtils
-from Utils import create_cache
-from Utils import list_files
-from Utils import load_cache
+from ManifestCache import ManifestCache
+from Utils import scan_files
 
 csv_ext = '.csv'
 log = LoggerUtils.get_logger('PatientDiagnosisLoader')
@@ -24,46 +23,54 @@ def parse_file(csvfile, diagnosis):
                 '["PatientID (LIDC-IDRI-####)", '
                 '"Diagnose (0-3)" ], row {}'.format(row))
         if row[0] in diagnosis:
-            log.warn('Duplicate diagnose found '
-                     'for patient {}'.format(row[0]))
+            log.warn('Duplicate diagnose found for patient %s', row[0])
         diagnosis[row[0]] = row[1]
 
 
+def parse_diagnosis_file(file):
+    diagnosis = {}
+
+    try:
+        with open(file, newline='') as csvfile:
+            parse_file(csvfile, diagnosis)
+        return diagnosis, False
+    except ValueError:
+        log.error('Can\'t load diagnosis file %s', file, exc_info=True)
+        return diagnosis, True
+
+
+def merge_diagnosis(diagnosis, file_diagnosis):
+    for patient, diagnose in file_diagnosis.items():
+        if patient in diagnosis:
+            log.warn('Duplicate diagnose found for patient %s', patient)
+        diagnosis[patient] = diagnose
+
+
 class PatientDiagnosisLoader(object):
     def __init__(self, diagnosis_path):
-        log.info('Patient diagnosis directory: {}'
-                 .format(diagnosis_path))
+        log.info('Patient diagnosis directory: %s', diagnosis_path)
         self._diagnosis_path = diagnosis_path
 
     def load_dicoms_metadata(self):
-        cache_file = join(self._diagnosis_path, cache_file_name)
+        cache = ManifestCache(join(self._diagnosis_path,
+                                   cache_file_name), log)
+        cache.load()
 
-        if isfile(cache_file):
-            log.info('Found cache file with diagnosis, '
-                     'delete it to reload: {}. Loading...'
-                     .format(cache_file))
-            return load_cache(cache_file)
+        files = scan_files(self._diagnosis_path, csv_ext)
+        file_counter = 1
+
+        for file in cache.refresh(files):
+            log.info('Parsing diagnosis file %s: %s', file_counter, file)
+            file_counter += 1
+            with instrumentation.timer('diagnosis.parse_seconds'):
+                file_diagnosis, failed = parse_diagnosis_file(file)
+            cache.store(file, file_diagnosis, failed)
 
         diagnosis = {}
-        files = list_files(self._diagnosis_path, csv_ext)
-        error_files = []
-        file_counter = 1
 
-        for file in files:
-            try:
-                log.info('Parsing diagnosis file {} of {}: {}'
-                         .format(file_counter, len(files), file))
-                with open(file, newline='') as csvfile:
-                    parse_file(csvfile, diagnosis)
-            except ValueError:
-                error_files.append(file)
-                log.error('Can\'t load diagnosis file {}'
-                          .format(file), exc_info=True)
-            finally:
-                file_counter += 1
-
-        log.info('Creating diagnosis cache: {}'
-                 .format(cache_file))
-        create_cache(cache_file, diagnosis, log)
+        for file, file_diagnosis in cache.entries():
+            merge_diagnosis(diagnosis, file_diagnosis)
+
+        cache.save()
 
         return diagnosis
@@ -0,0 +1,195 @@
+# coding=utf-8
+from math import sqrt
+
+from numpy import add
+from numpy import arange
+from numpy import array
+from numpy import nonzero
+from numpy import roll
+from numpy import zeros
+
+# Masks used to be computed with matplotlib Path.contains_points
+# with radius=-1. For such a radius matplotlib does not test the
+# polygon itself, but its contour built by agg (conv_contour) with
+# a half pixel offset and miter joins, so pixels on the edges are
+# included or excluded depending on the polygon orientation. The
+# same contour is built here and then filled with the same crossing
+# test, so masks match the old ones exactly.
+contour_radius = -1.0
+miter_limit = 4.0
+inner_miter_limit = 1.01
+vertex_dist_epsilon = 1e-14
+intersection_epsilon = 1e-30
+
+
+def _distance(x1, y1, x2, y2):
+    dx = x2 - x1
+    dy = y2 - y1
+    return sqrt(dx * dx + dy * dy)
+
+
+def _cross_product(x1, y1, x2, y2, x, y):
+    return (x - x2) * (y2 - y1) - (y - y2) * (x2 - x1)
+
+
+def _intersection(ax, ay, bx, by, cx, cy, dx, dy):
+    num = (ay - cy) * (dx - cx) - (ax - cx) * (dy - cy)
+    den = (bx - ax) * (dy - cy) - (by - ay) * (dx - cx)
+
+    if abs(den) < intersection_epsilon:
+        return None
+
+    r = num / den
+    return ax + r * (bx - ax), ay + r * (by - ay)
+
+
+def _coincident(v1, v2):
+    return _distance(v1[0], v1[1], v2[0], v2[1]) <= vertex_dist_epsilon
+
+
+def _source_vertices(xc, yc):
+    # a closed matplotlib path ignores its last vertex, agg then
+    # drops coincident neighbours and the vertices equal to the first
+    vertices = []
+
+    for x, y in zip(xc[:-1], yc[:-1]):
+        vertex = float(x), float(y)
+        if not vertices or not _coincident(vertices[-1], vertex):
+            vertices.append(vertex)
+
+    while len(vertices) > 1 and _coincident(vertices[-1], vertices[0]):
+        vertices.pop()
+
+    return vertices
+
+
+def _miter(out, v0, v1, v2, dx1, dy1, dx2, dy2,
+           width, revert, limit, dbevel):
+    xi, yi = v1
+    di = 1.0
+    lim = abs(width) * limit
+    limit_exceeded = True
+    intersection = _intersection(v0[0] + dx1, v0[1] - dy1,
+                                 v1[0] + dx1, v1[1] - dy1,
+                                 v1[0] + dx2, v1[1] - dy2,
+                                 v2[0] + dx2, v2[1] - dy2)
+
+    if intersection is not None:
+        xi, yi = intersection
+        di = _distance(v1[0], v1[1], xi, yi)
+        if di <= lim:
+            out.append((xi, yi))
+            limit_exceeded = False
+    else:
+        # the three points lie on one line, check whether the next
+        # segment continues the previous one or goes back
+        x2 = v1[0] + dx1
+        y2 = v1[1] - dy1
+        if (_cross_product(v0[0], v0[1], v1[0], v1[1], x2, y2) < 0.0) \
+                == (_cross_product(v1[0], v1[1], v2[0], v2[1], x2, y2)
+                    < 0.0):
+            out.append((v1[0] + dx1, v1[1] - dy1))
+            limit_exceeded = False
+
+    if limit_exceeded:
+        if revert:
+            out.append((v1[0] + dx1, v1[1] - dy1))
+            out.append((v1[0] + dx2, v1[1] - dy2))
+        elif intersection is None:
+            limit *= -1.0 if width < 0 else 1.0
+            out.append((v1[0] + dx1 + dy1 * limit,
+                        v1[1] - dy1 + dx1 * limit))
+            out.append((v1[0] + dx2 - dy2 * limit,
+                        v1[1] - dy2 - dx2 * limit))
+        else:
+            x1 = v1[0] + dx1
+            y1 = v1[1] - dy1
+            x2 = v1[0] + dx2
+            y2 = v1[1] - dy2
+            di = (lim - dbevel) / (di - dbevel)
+            out.append((x1 + (xi - x1) * di, y1 + (yi - y1) * di))
+            out.append((x2 + (xi - x2) * di, y2 + (yi - y2) * di))
+
+
+def _join(out, v0, v1, v2, len1, len2, width):
+    dx1 = width * (v1[1] - v0[1]) / len1
+    dy1 = width * (v1[0] - v0[0]) / len1
+    dx2 = width * (v2[1] - v1[1]) / len2
+    dy2 = width * (v2[0] - v1[0]) / len2
+    cp = _cross_product(v0[0], v0[1], v1[0], v1[1], v2[0], v2[1])
+
+    if (cp > vertex_dist_epsilon and width > 0) or \
+            (cp < -vertex_dist_epsilon and width < 0):
+        limit = (len1 if len1 < len2 else len2) / abs(width)
+        if limit < inner_miter_limit:
+            limit = inner_miter_limit
+        _miter(out, v0, v1, v2, dx1, dy1, dx2, dy2,
+               width, True, limit, 0.0)
+    else:
+        dx = (dx1 + dx2) / 2
+        dy = (dy1 + dy2) / 2
+        dbevel = sqrt(dx * dx + dy * dy)
+        _miter(out, v0, v1, v2, dx1, dy1, dx2, dy2,
+               width, False, miter_limit, dbevel)
+
+
+def contour_polygon(xc, yc, radius=contour_radius):
+    vertices = _source_vertices(xc, yc)
+    count = len(vertices)
+
+    if count < 3:
+        return array([]), array([])
+
+    lengths = [_distance(v1[0], v1[1], v2[0], v2[1]) for v1, v2
+               in zip(vertices, vertices[1:] + vertices[:1])]
+    width = radius * 0.5
+    out = []
+
+    for i in range(count):
+        _join(out,
+              vertices[i - 1],
+              vertices[i],
+              vertices[(i + 1) % count],
+              lengths[i - 1],
+              lengths[i],
+              width)
+
+    return array([x for x, _ in out]), array([y for _, y in out])
+
+
+def polygon_mask(xc, yc, x_min, y_min, x_max, y_max):
+    # even-odd fill of the pixels x_min <= x < x_max, y_min <= y < y_max
+    mask = zeros((max(y_max - y_min, 0), max(x_max - x_min, 0)),
+                 dtype=bool)
+    ox, oy = contour_polygon(xc, yc)
+
+    if not ox.size or not mask.size:
+        return mask
+
+    ox0, oy0 = ox, oy
+    ox1, oy1 = roll(ox, -1), roll(oy, -1)
+    tx = arange(x_min, x_max, dtype=float)
+    ty = arange(y_min, y_max, dtype=float)
+
+    # only edges crossing a scanline have to be tested against
+    # the pixels of that scanline
+    y_flag0 = oy0[None, :] >= ty[:, None]
+    y_flag1 = oy1[None, :] >= ty[:, None]
+    rows, edges = nonzero(y_flag0 != y_flag1)
+
+    if not rows.size:
+        return mask
+
+    lhs = (oy1[edges] - ty[rows]) * (ox0[edges] - ox1[edges])
+    rhs = (ox1[edges][:, None] - tx[None, :]) * \
+        (oy0[edges] - oy1[edges])[:, None]
+    hits = (lhs[:, None] >= rhs) == y_flag1[rows, edges][:, None]
+
+    crossings = zeros(mask.shape, dtype='uint16')
+    add.at(crossings, rows, hits)
+
+    return (crossings & 1).astype(bool)
+
+
+def bounding_box(xc, yc):
+    return int(min(xc)), int(min(yc)), int(max(xc)), int(max(yc))
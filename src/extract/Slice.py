@@ -1,39 +1,54 @@
 # coding=utf-8
+from collections import namedtuple
+from uuid import UUID
 from uuid import uuid4
 
-from matplotlib.path import Path
 from numpy import array
-from numpy import mgrid
-from numpy import vstack
+from numpy import array_equal
+from numpy import packbits
+from numpy import unpackbits
 
+from extract.Rasterizer import bounding_box
+from extract.Rasterizer import polygon_mask
+
+Point = namedtuple('Point', 'x y')
+vertex_type = 'int16'
 
-def area(points):
-    # return self._area if self._area else
 
-    xc = array([point.x for point in points])
-    yc = array([point.y for point in points])
+def to_vertices(points):
+    return array(points, dtype=vertex_type).reshape(-1, 2)
 
-    nr, nc = yc.max() - yc.min() + 1, xc.max() - xc.min() + 1
 
-    xc -= xc.min()
-    yc -= yc.min()
+def rasterize(points):
+    # mask of the bounding box of the points, the last row and
+    # column included
+    vertices = to_vertices(points)
+    xc, yc = vertices[:, 0], vertices[:, 1]
+    x_min, y_min, x_max, y_max = bounding_box(xc, yc)
 
-    xy_crop = vstack((xc, yc)).T
+    return polygon_mask(xc - x_min, yc - y_min,
+                        0, 0, x_max - x_min + 1, y_max - y_min + 1)
 
-    y_grid, x_grid = mgrid[:nr, :nc]
-    xy_pix = vstack((x_grid.ravel(), y_grid.ravel())).T
-    pth = Path(xy_crop, closed=True)
 
-    return int(sum(pth.contains_points(xy_pix, radius=-1)))
+def area(points):
+    return int(rasterize(points).sum())
 
 
 class Slice(object):
+    # lots of slices are kept in memory and pickled into caches,
+    # so instances have no __dict__ and keep vertices in one array
+    __slots__ = ('_image_uid', '_z_pos', '_mask', '_area',
+                 '_uid', '_vertices')
+
     def __init__(self, image_uid, z_pos, points):
         self._image_uid = image_uid
         self._z_pos = float(z_pos)
-        self._area = area(points)
-        self._uid = uuid4().hex
-        self._points = tuple(points)
+        # mask is computed on demand and kept packed
+        self._mask = None
+        self._area = None
+        self._uid = uuid4().bytes
+        self._vertices = to_vertices(points)
+        self._vertices.flags.writeable = False
 
     @property
     def image_uid(self):
@@ -45,15 +60,56 @@ class Slice(object):
 
     @property
     def area(self):
+        if self._area is None:
+            self._rasterize()
         return self._area
 
+    @property
+    def origin(self):
+        return int(self._vertices[:, 0].min()), \
+               int(self._vertices[:, 1].min())
+
+    @property
+    def mask(self):
+        if self._mask is None:
+            self._rasterize()
+        packed, shape = self._mask
+        return unpackbits(packed)[:shape[0] * shape[1]] \
+            .reshape(shape).astype(bool)
+
     @property
     def uid(self):
-        return self._uid
+        return UUID(bytes=self._uid).hex
+
+    @property
+    def vertices(self):
+        return self._vertices
 
     @property
     def points(self):
-        return self._points
+        return tuple([Point(int(x), int(y)) for x, y in self._vertices])
+
+    def _rasterize(self):
+        mask = rasterize(self._vertices)
+        self._mask = packbits(mask), mask.shape
+        self._area = int(mask.sum())
+
+    def __getstate__(self):
+        return self._image_uid, self._z_pos, self._mask, self._area, \
+               self._uid, self._vertices
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # caches pickled before __slots__ keep a plain __dict__
+            uid = state['_uid']
+            state = (state['_image_uid'], state['_z_pos'],
+                     state.get('_mask'), state.get('_area'),
+                     UUID(hex=uid).bytes if isinstance(uid, str) else uid,
+                     to_vertices(state['_points']))
+
+        self._image_uid, self._z_pos, self._mask, self._area, \
+            self._uid, self._vertices = state
+        self._vertices.flags.writeable = False
 
     def __eq__(self, other):
         if not isinstance(other, Slice):
@@ -62,20 +118,20 @@ class Slice(object):
         return \
             self.image_uid == other.image_uid and \
             self.z_pos == other.z_pos and \
-            self.points == other.points
+            array_equal(self.vertices, other.vertices)
 
     def __hash__(self, *args, **kwargs):
         return hash((self._image_uid,
                      self._z_pos,
-                     self._points))
+                     self._vertices.tobytes()))
 
     def __repr__(self, *args, **kwargs):
         return ''.join(['Slice(',
                         str(self._image_uid), ',',
                         str(self._z_pos), ',',
                         str(self._area), ',',
-                        str(self._uid), ',',
-                        str(self._points), ')'])
+                        str(self.uid), ',',
+                        str(self.points), ')'])
 
     def __str__(self, *args, **kwargs):
         return self.__repr__(*args, **kwargs)
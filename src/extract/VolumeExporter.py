@@ -0,0 +1,161 @@
+# coding=utf-8
+from functools import partial
+from os import makedirs
+from os import replace
+from os.path import join
+
+from numpy import diff
+from numpy import load as load_array
+from numpy import median
+from numpy.lib.format import open_memmap
+
+from LoggerUtils import LoggerUtils
+from Utils import create_cache
+from Utils import load_cache
+from Utils import map_parallel
+from Utils import source_fingerprint
+from extract.DicomHeaderReader import image_position
+from extract.Hounsfield import hounsfield_min
+from extract.Hounsfield import hounsfield_type
+from extract.Hounsfield import pixel_view
+from extract.Hounsfield import to_hounsfield
+
+log = LoggerUtils.get_logger('VolumeExporter')
+volumes_directory = 'volumes'
+volumes_cache_name = 'volumes.cache'
+# volumes are not windowed, they depend on the hounsfield
+# type and the value of undecodable slices only
+volumes_fingerprint = source_fingerprint(hounsfield_type, hounsfield_min)
+
+
+def z_spacing(z_positions):
+    # unknown for volumes of a single slice
+    if len(z_positions) > 1:
+        return float(median(diff(z_positions)))
+
+    return 0.0
+
+
+def export_series_volume(series_images, volumes_path):
+    # images are sorted by z position of the metadata and written one
+    # by one into a memory mapped file, so a series is never held in
+    # memory and every file is read once
+    from dicom import read_file
+
+    (study, series), images = series_images
+
+    for _, image in images:
+        if image.z is None:
+            log.error('Image %s has no z position and is excluded from '
+                      'volume of series %s', image.path, series)
+
+    images = sorted([i for i in images if i[1].z is not None],
+                    key=lambda i: (i[1].z, i[1].path))
+
+    if not images:
+        log.error('No images found for volume of series %s', series)
+        return None
+
+    file_name = '{}_{}.npy'.format(study, series)
+    temp_file = join(volumes_path, file_name + '.tmp')
+    volume = None
+    failed = []
+
+    for index, (_, image) in enumerate(images):
+        try:
+            ds = read_file(image.path)
+            pixels = pixel_view(ds)
+
+            if volume is None:
+                # the first image read gives the shape and the
+                # spacing of the volume
+                shape = pixels.shape
+                spacing = tuple([float(s) for s in ds.PixelSpacing])
+                x, y = image_position(ds)[:2]
+                volume = open_memmap(temp_file, mode='w+',
+                                     dtype=hounsfield_type,
+                                     shape=(len(images),) + shape)
+                volume[:index] = hounsfield_min
+
+            if pixels.shape != shape:
+                raise ValueError('Image of shape {} in volume of shape {}'
+                                 .format(pixels.shape, shape))
+
+            to_hounsfield(pixels, image.slope, image.intercept,
+                          out=volume[index])
+        except (ValueError, AttributeError):
+            # zeros of the new file would pass for water
+            if volume is not None:
+                volume[index] = hounsfield_min
+
+            failed.append(index)
+            log.error('Can\'t load image from file %s, its volume slice '
+                      'is filled with %s', image.path, hounsfield_min,
+                      exc_info=True)
+
+    if volume is None:
+        log.error('No images could be read for volume of series %s',
+                  series)
+        return None
+
+    volume.flush()
+    del volume
+    replace(temp_file, join(volumes_path, file_name))
+
+    z_positions = [i[1].z for i in images]
+    row_spacing, column_spacing = spacing
+
+    return (study, series), {
+        'file': file_name,
+        'shape': (len(images),) + shape,
+        # z, y, x in millimeters
+        'spacing': (z_spacing(z_positions),
+                    row_spacing, column_spacing),
+        'origin': (x, y, z_positions[0]),
+        'z_positions': tuple(z_positions),
+        # image uid -> index of the slice in the volume
+        'slices': dict((image_uid, index)
+                       for index, (image_uid, _) in enumerate(images)),
+        # indexes of slices filled with hounsfield_min
+        'failed_slices': tuple(failed)
+    }
+
+
+def export_volumes(series_keys, metadata, output_path, jobs=1):
+    volumes_path = join(output_path, volumes_directory)
+    makedirs(volumes_path, exist_ok=True)
+
+    tasks = [((study, series), list(metadata[study][series].items()))
+             for study, series in series_keys]
+    export = partial(export_series_volume, volumes_path=volumes_path)
+    volumes = {}
+    series_count = 1
+
+    log.info('Exporting volumes of %s series with %s job(s)', len(tasks), jobs)
+
+    for result in map_parallel(export, tasks, jobs):
+        log.info('Exported volume %s of %s', series_count, len(tasks))
+        series_count += 1
+
+        if result is not None:
+            key, volume_info = result
+            volumes[key] = volume_info
+
+    cache_file = join(volumes_path, volumes_cache_name)
+
+    log.info('Creating cache with %s volumes info: %s', len(volumes),
+             cache_file)
+    create_cache(cache_file, volumes, log, volumes_fingerprint)
+
+    return volumes
+
+
+def load_volumes(output_path):
+    return load_cache(join(output_path, volumes_directory,
+                           volumes_cache_name), volumes_fingerprint)
+
+
+def open_volume(output_path, volume_info):
+    # the volume is mapped read only, slices are read on demand
+    return load_array(join(output_path, volumes_directory,
+                           volume_info['file']), mmap_mode='r')
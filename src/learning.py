@@ -2,7 +2,10 @@
 import logging
 from argparse import ArgumentParser
 from importlib import reload
+from os.path import splitext
 
+from Instrumentation import instrumentation
+from LoggerUtils import LoggerUtils
 from learning.Datasets import supported_datasets, LIDCCancerType, \
     LIDCMalignancy
 from learning.LearningExecutor import execute_learning
@@ -10,6 +13,8 @@ from learning.Models import supported_models
 
 reload(logging)
 
+metrics_file_suffix = '.metrics.json'
+
 
 def main():
     parser = ArgumentParser(
@@ -37,6 +42,15 @@ def main():
                         type=int,
                         required=True,
                         help='Number of bootstrap iterations')
+    parser.add_argument('-s', '--seed',
+                        dest='seed',
+                        metavar='SEED',
+                        type=int,
+                        default=None,
+                        required=False,
+                        help='Seed of the bootstrap samples generator, '
+                             'the same seed gives the same train and '
+                             'test sets. Random by default')
     parser.add_argument('-o', '--output_file',
                         dest='output_file',
                         metavar='OUTPUT_FILE',
@@ -49,7 +63,9 @@ def main():
                         help='Specified path to extracted nodule '
                              'images with extracted nodules '
                              'info cache for LIDC models')
+    LoggerUtils.add_log_level_argument(parser)
     args = parser.parse_args()
+    LoggerUtils.set_level(args.log_level)
 
     for model in args.models:
         if model not in supported_models:
@@ -70,12 +86,17 @@ def main():
         parser.print_help()
         exit(-1)
 
-    dataset = supported_datasets[args.dataset](args)
+    with instrumentation.stage('dataset'):
+        dataset = supported_datasets[args.dataset](args)
+
+    with instrumentation.stage('learning'):
+        execute_learning(dataset,
+                         models,
+                         args.iterations,
+                         args.output_file)
 
-    execute_learning(dataset,
-                     models,
-                     args.iterations,
-                     args.output_file)
+    instrumentation.write(splitext(args.output_file)[0] +
+                          metrics_file_suffix)
 
 
 if __name__ == '__main__':
@@ -1,21 +1,37 @@
 # coding=utf-8
-from functools import reduce
+from logging import DEBUG
+from os.path import basename
+from os.path import getmtime
+from os.path import isdir
 from os.path import isfile
 from os.path import join
 from os.path import splitext
 
-from PIL import Image
-from keras.datasets import cifar10
-from keras.datasets import mnist
+from numpy import ascontiguousarray
 from numpy import asarray
 from numpy import concatenate
-from numpy.random import choice
+from numpy import empty
+from numpy import flatnonzero
+from numpy import isin
+from numpy import zeros
+from numpy.random import RandomState
 
+from Instrumentation import instrumentation
 from LoggerUtils import LoggerUtils
+from Utils import CacheError
 from Utils import create_cache
+from Utils import file_signature
 from Utils import load_cache
+from Utils import source_fingerprint
+from Utils import table_file
+from extract.AnnotationStore import open_store
+from extract.ImageStore import ImageStore
 from extract.DicomLoader import slice_image_name
+from extract.ImageExtractor import images_store_name
 from extract.ImageExtractor import slices_cache_name
+from extract.ImageExtractor import slices_store_name
+from extract.MetadataIndex import MetadataIndex
+from extract.MetadataIndex import index_file_name
 
 min_area = 100
 cache_file_name = 'images.cache'
@@ -28,9 +44,12 @@ class Dataset(object):
     _x = None
     _y = None
 
-    # noinspection PyUnusedLocal
     def __init__(self, args):
         super().__init__()
+        self._iterations = args.iterations
+        self._random = RandomState(args.seed)
+        self._masks = None
+        self._iteration = 0
 
     @property
     def x(self):
@@ -41,46 +60,47 @@ class Dataset(object):
         return self._y
 
     def bootstrap_iter(self):
-        train_indexes = set(choice(self.y.shape[0],
-                                   size=self.y.shape[0],
-                                   replace=True))
-        test_indexes = list(set(range(self.y.shape[0])) - train_indexes)
-        train_indexes = list(train_indexes)
+        # samples drawn at least once are the train set, the ones
+        # never drawn are the test set. Samples of all iterations are
+        # drawn on the first call, so they depend on the seed only.
+        if self._masks is None:
+            self._masks = bootstrap_masks(self.y.shape[0],
+                                          self._iterations,
+                                          self._random)
 
-        y_train = asarray([self.y[i] for i in train_indexes])
-        y_test = asarray([self.y[i] for i in test_indexes])
+        in_bag = self._masks[self._iteration % len(self._masks)]
+        self._iteration += 1
+        train_indexes = flatnonzero(in_bag)
+        test_indexes = flatnonzero(~in_bag)
 
-        x_train = asarray([self.x[i] for i in train_indexes])
-        x_test = asarray([self.x[i] for i in test_indexes])
-
-        return (x_train, y_train), (x_test, y_test)
+        return (self.x[train_indexes], self.y[train_indexes]), \
+               (self.x[test_indexes], self.y[test_indexes])
 
 
 class MNIST(Dataset):
     def __init__(self, args):
         super().__init__(args)
+        from keras.datasets import mnist
         (x_train, y_train), (x_test, y_test) = mnist.load_data()
         x = concatenate((x_train, x_test))
         y = concatenate((y_train, y_test))
-        filtered = [(x, y) for (x, y) in zip(x, y) if y < 2]
-        self._x = list(asarray([x for (x, y) in filtered]))
-        self._y = asarray([y for (x, y) in filtered])
-        log.info('Dataset {} successfully imported'
-                 .format(MNIST.__name__))
+        kept = (y < 2).ravel()
+        self._x = x[kept]
+        self._y = y[kept]
+        log.info('Dataset %s successfully imported', MNIST.__name__)
 
 
 class CIFAR10(Dataset):
     def __init__(self, args):
         super().__init__(args)
+        from keras.datasets import cifar10
         (x_train, y_train), (x_test, y_test) = cifar10.load_data()
         x = concatenate((x_train, x_test))
         y = concatenate((y_train, y_test))
-        filtered = [(x, y) for (x, y) in zip(x, y) if y < 2]
-        self._x = list(asarray([x for (x, y) in filtered])
-                       .transpose((0, 2, 3, 1)))
-        self._y = asarray([y for (x, y) in filtered])
-        log.info('Dataset {} successfully imported'
-                 .format(CIFAR10.__name__))
+        kept = (y < 2).ravel()
+        self._x = ascontiguousarray(x[kept].transpose((0, 2, 3, 1)))
+        self._y = y[kept]
+        log.info('Dataset %s successfully imported', CIFAR10.__name__)
 
 
 class LIDC(Dataset):
@@ -91,47 +111,86 @@ class LIDC(Dataset):
 
         cache_file = join(self._images_path, cache_file_name)
         slices_cache_file = join(self._images_path, slices_cache_name)
-
-        if isfile(cache_file):
-            log.info('Found cache file with LIDC images, '
-                     'delete it to reload: {}. Loading...'
-                     .format(cache_file))
-            self._x, self._y = load_cache(cache_file)
+        images_store = join(self._images_path, images_store_name)
+
+        # images caches are rebuilt once the images are extracted again
+        if isdir(images_store):
+            source = file_signature(table_file(images_store,
+                                               'store', 'version'))
+        elif isfile(slices_cache_file):
+            source = file_signature(slices_cache_file)
+        else:
+            source = None
+
+        self._fingerprint = source_fingerprint(source, min_area)
+        cached = None if isdir(images_store) else \
+            load_images_cache(cache_file, self._fingerprint)
+
+        if isdir(images_store):
+            log.info('Found packed nodule images, loading the ones with '
+                     'the biggest area greater than %s from store %s',
+                     min_area, images_store)
+            store = ImageStore(images_store)
+            rows = store.biggest_slices(min_area)
+            # images are views of the mapped store
+            self._x = image_array([store.image(row) for row in rows])
+            self._y = asarray(store.index['malignancy'][rows],
+                              dtype='uint8')
+        elif cached is not None:
+            self._x, self._y = cached
         else:
-            log.info('Loading exported slices info from cache {}'
-                     .format(slices_cache_file))
+            index_file = join(self._images_path, index_file_name)
+
+            # an index older than the extracted slices is left over
+            # by an extraction without it
+            if isfile(index_file) and not (isfile(slices_cache_file) and
+                                           getmtime(slices_cache_file) >
+                                           getmtime(index_file)):
+                log.info('Selecting nodule slices with the biggest area '
+                         'greater than %s from index %s', min_area, index_file)
+
+                with MetadataIndex(index_file) as index:
+                    nodules = index.biggest_slices(min_area=min_area)
+            else:
+                slices_store = join(self._images_path, slices_store_name)
+
+                log.info('Loading exported slices info from store %s',
+                         slices_store)
 
-            extracted_nodules = load_cache(slices_cache_file)
+                store = open_store(slices_store, slices_cache_file)
 
-            log.info('Computing nodule slices with the biggest area '
-                     'greater than {}'.format(min_area))
+                log.info('Computing nodule slices with the biggest area '
+                         'greater than %s', min_area)
+
+                # only the selected slices are read from the store
+                nodules = store.biggest_slices(min_area=min_area)
 
             image_files = [slice_image_name(self._images_path,
                                             nodule,
-                                            biggest_slice(nodule))
-                           for nodule in extracted_nodules
-                           if biggest_slice(nodule).area > min_area]
+                                            nodule_slice)
+                           for nodule in nodules
+                           for nodule_slice in nodule.slices]
 
-            log.info('{} slices have been selected to load'
-                     .format(len(image_files)))
+            log.info('%s slices have been selected to load', len(image_files))
 
             log.info('Loading images')
 
-            self._x = [load_image(f) for f in image_files]
+            with instrumentation.stage('images', len(image_files)):
+                self._x = image_array([load_image(f)
+                                       for f in image_files])
             classes = [file_suffix(file) for file in image_files]
             self._y = asarray(classes, dtype='uint8')
 
-            log.info('Creating images cache: {}'
-                     .format(cache_file))
-            create_cache(cache_file, (self._x, self._y), log)
+            log.info('Creating images cache: %s', cache_file)
+            create_cache(cache_file, (self._x, self._y), log,
+                         self._fingerprint)
 
-        log.info('{} images have been loaded'.format(self._y.shape[0]))
+        log.info('%s images have been loaded', self._y.shape[0])
 
     def filter(self, classes):
-        filtered = [(x, classes[y]) for (x, y)
-                    in zip(self._x, self._y) if y in classes]
-        self._x = list(asarray([x for (x, y) in filtered]))
-        self._y = asarray([y for (x, y) in filtered])
+        kept = isin(self._y, list(classes))
+        self._x = self._x[kept]
+        self._y = asarray([classes[y] for y in self._y[kept]])
 
 
 class LIDCCancerType(LIDC):
@@ -142,23 +201,20 @@ class LIDCCancerType(LIDC):
         super().__init__(args)
 
         cache_file = join(self._images_path, cache_file_name_ct)
+        fingerprint = source_fingerprint(self._fingerprint,
+                                         LIDCCancerType.classes)
+        cached = load_images_cache(cache_file, fingerprint, True)
 
-        if isfile(cache_file):
-            log.info('Found cache file with filtered LIDC images, '
-                     'delete it to reload: {}. Loading...'
-                     .format(cache_file))
-            self._x, self._y = load_cache(cache_file)
+        if cached is not None:
+            self._x, self._y = cached
         else:
             log.info('Filtering images according to the class values')
             self.filter(LIDCCancerType.classes)
-            log.info('Creating filtered images cache: {}'
-                     .format(cache_file))
-            create_cache(cache_file, (self._x, self._y), log)
-        log.info('{} images left after filtering'
-                 .format(self._y.shape[0]))
+            log.info('Creating filtered images cache: %s', cache_file)
+            create_cache(cache_file, (self._x, self._y), log, fingerprint)
+        log.info('%s images left after filtering', self._y.shape[0])
 
-        log.info('Dataset {} successfully imported'
-                 .format(LIDCCancerType.__name__))
+        log.info('Dataset %s successfully imported', LIDCCancerType.__name__)
 
 
 class LIDCMalignancy(LIDC):
@@ -169,34 +225,75 @@ class LIDCMalignancy(LIDC):
         super().__init__(args)
 
         cache_file = join(self._images_path, cache_file_name_m)
+        fingerprint = source_fingerprint(self._fingerprint,
+                                         LIDCMalignancy.classes)
+        cached = load_images_cache(cache_file, fingerprint, True)
 
-        if isfile(cache_file):
-            log.info('Found cache file with filtered LIDC images, '
-                     'delete it to reload: {}. Loading...'
-                     .format(cache_file))
-            self._x, self._y = load_cache(cache_file)
+        if cached is not None:
+            self._x, self._y = cached
         else:
             log.info('Filtering images according to the class values')
             self.filter(LIDCMalignancy.classes)
-            log.info('Creating filtered images cache: {}'
-                     .format(cache_file))
-            create_cache(cache_file, (self._x, self._y), log)
-        log.info('{} images left after filtering'
-                 .format(self._y.shape[0]))
+            log.info('Creating filtered images cache: %s', cache_file)
+            create_cache(cache_file, (self._x, self._y), log, fingerprint)
+        log.info('%s images left after filtering', self._y.shape[0])
+
+        log.info('Dataset %s successfully imported', LIDCMalignancy.__name__)
+
+
+def load_images_cache(cache_file, fingerprint, filtered=False):
+    # returns None if there is no valid cache
+    name = basename(cache_file)
+
+    if not isfile(cache_file):
+        instrumentation.count('{}.misses'.format(name))
+        return None
+
+    log.info('Found cache file with %sLIDC images, '
+             'delete it to reload: %s. Loading...',
+             'filtered ' if filtered else '', cache_file)
 
-        log.info('Dataset {} successfully imported'
-                 .format(LIDCMalignancy.__name__))
+    try:
+        cached = load_cache(cache_file, fingerprint)
+    except CacheError as e:
+        log.warn('%s, it will be rebuilt', e)
+        instrumentation.count('{}.misses'.format(name))
+        return None
+
+    instrumentation.count('{}.hits'.format(name))
+    # caches written before images were kept in an array have a list
+    images, classes = cached
+    return image_array(images), classes
+
+
+def image_array(images):
+    # nodule images differ in shape, so they are kept in an object
+    # array and indexing it copies references instead of pixels
+    array = empty(len(images), dtype=object)
+
+    for i, image in enumerate(images):
+        array[i] = image
+
+    return array
+
+
+def bootstrap_masks(size, iterations, random):
+    # in-bag samples of every bootstrap iteration
+    masks = zeros((max(iterations, 1), size), dtype=bool)
+
+    for mask in masks:
+        mask[random.randint(0, size, size)] = True
+
+    return masks
 
 
 def load_image(path):
-    log.debug('Loading image {}'.format(path))
-    return asarray(Image.open(path).convert('L'), dtype='uint8')
+    from PIL import Image
 
+    if log.isEnabledFor(DEBUG):
+        log.debug('Loading image %s', path)
 
-def biggest_slice(nodule):
-    return reduce(lambda a, b:
-                  a if a.area > b.area else b,
-                  nodule.slices)
+    return asarray(Image.open(path).convert('L'), dtype='uint8')
 
 
 def file_suffix(file_name):
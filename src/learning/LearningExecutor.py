@@ -2,9 +2,9 @@
 from csv import QUOTE_MINIMAL
 from csv import writer
 
-from keras.utils.np_utils import to_categorical
 from numpy import asarray
 
+from Instrumentation import instrumentation
 from LoggerUtils import LoggerUtils
 from Utils import scale_image
 from learning.Metrics import supported_metrics
@@ -13,6 +13,7 @@ log = LoggerUtils.get_logger('LearningEvaluator')
 
 
 def categorize(class_values):
+    from keras.utils.np_utils import to_categorical
     return to_categorical(class_values, 2)
 
 
@@ -37,7 +38,11 @@ def execute(dataset, models, iterations, csvwriter):
 
     for i in range(1, iterations + 1):
         log.info('Bootstrap iteration {}'.format(i))
-        (x_train, y_train), (x_test, y_test) = dataset.bootstrap_iter()
+
+        with instrumentation.stage('bootstrap'):
+            (x_train, y_train), (x_test, y_test) = \
+                dataset.bootstrap_iter()
+
         for model in models:
             log.debug('Model {}'.format(type(model).__name__))
 
@@ -45,19 +50,24 @@ def execute(dataset, models, iterations, csvwriter):
             classifier.compile(loss='binary_crossentropy',
                                optimizer='Adadelta')
 
-            x_train_scaled = scale(x_train, model.size)
-            x_test_scaled = scale(x_test, model.size)
-            y_train_categorized = categorize(y_train)
+            with instrumentation.stage('scale',
+                                       len(x_train) + len(x_test)):
+                x_train_scaled = scale(x_train, model.size)
+                x_test_scaled = scale(x_test, model.size)
+                y_train_categorized = categorize(y_train)
 
             log.info("Training network")
-            classifier.fit(x_train_scaled, y_train_categorized,
-                           batch_size=1,
-                           nb_epoch=1,
-                           verbose=1,
-                           shuffle=False)
-
-            result = list(classifier.predict_classes(x_test_scaled,
-                                                     batch_size=32))
+
+            with instrumentation.stage('fit', len(x_train_scaled)):
+                classifier.fit(x_train_scaled, y_train_categorized,
+                               batch_size=1,
+                               nb_epoch=1,
+                               verbose=1,
+                               shuffle=False)
+
+            with instrumentation.stage('predict', len(x_test_scaled)):
+                result = list(classifier.predict_classes(x_test_scaled,
+                                                         batch_size=32))
             metric_values = [metric_value(x, y_test, result)
                              for x in supported_metrics]
             metrics = [str(i), type(model).__name__] + metric_values
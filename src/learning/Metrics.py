@@ -1,17 +1,9 @@
 # coding=utf-8
-from sklearn.metrics import accuracy_score
-from sklearn.metrics import auc
-from sklearn.metrics import confusion_matrix
-from sklearn.metrics import f1_score
-from sklearn.metrics import matthews_corrcoef
-from sklearn.metrics import precision_score
-from sklearn.metrics import recall_score
-from sklearn.metrics import roc_curve
-
 epsilon = 10e-8
 
 
 def get_basic_info(true, pred):
+    from sklearn.metrics import confusion_matrix
     conf_matrix = confusion_matrix(true, pred)
 
     tp = conf_matrix[0][0]
@@ -24,14 +16,17 @@ def get_basic_info(true, pred):
 
 
 def matthews_correlation(true, pred):
+    from sklearn.metrics import matthews_corrcoef
     return matthews_corrcoef(true, pred)
 
 
 def precision(true, pred):
+    from sklearn.metrics import precision_score
     return precision_score(true, pred)
 
 
 def recall(true, pred):
+    from sklearn.metrics import recall_score
     return recall_score(true, pred)
 
 
@@ -41,6 +36,7 @@ def specificity(true, pred):
 
 
 def accuracy(true, pred):
+    from sklearn.metrics import accuracy_score
     return accuracy_score(true, pred)
 
 
@@ -50,10 +46,13 @@ def npv(true, pred):
 
 
 def fmeasure(true, pred):
+    from sklearn.metrics import f1_score
     return f1_score(true, pred)
 
 
 def roc_auc(true, pred):
+    from sklearn.metrics import auc
+    from sklearn.metrics import roc_curve
     fpr, tpr, _ = roc_curve(true, pred)
     return auc(fpr, tpr)
 
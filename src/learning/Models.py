@@ -1,12 +1,4 @@
 # coding=utf-8
-from keras.layers import Activation
-from keras.layers import Dense
-from keras.layers import Flatten
-from keras.layers.convolutional import Convolution2D
-from keras.layers.convolutional import MaxPooling2D
-from keras.models import Sequential
-from keras.regularizers import l2
-
 depth = 1  # Grayscale
 
 
@@ -86,6 +78,14 @@ class LeNet(Net):
         self._size = 28
 
     def build(self):
+        from keras.layers import Activation
+        from keras.layers import Dense
+        from keras.layers import Flatten
+        from keras.layers.convolutional import Convolution2D
+        from keras.layers.convolutional import MaxPooling2D
+        from keras.models import Sequential
+        from keras.regularizers import l2
+
         model = Sequential(name='LeNet')
 
         model.add(Convolution2D(20, 5, 5,
@@ -117,6 +117,12 @@ class ResNet(Net):
         self._size = 224
 
     def build(self):
+        from keras.layers import Dense
+        from keras.layers import Flatten
+        from keras.layers.convolutional import Convolution2D
+        from keras.layers.convolutional import MaxPooling2D
+        from keras.models import Sequential
+
         model = Sequential(name='ResNet')
 
         model.add(Convolution2D(64, 3, 3,
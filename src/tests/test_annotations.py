@@ -0,0 +1,120 @@
+# coding=utf-8
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest import main
+
+from extract.AnnotationsLoader import AnnotationsLoader
+from extract.AnnotationsLoader import parse_nodules
+
+header = '''
+<ResponseHeader>
+  <Version>1.8.1</Version>
+  <StudyInstanceUID>1.2.3</StudyInstanceUID>
+  <SeriesInstanceUid>1.2.3.4</SeriesInstanceUid>
+</ResponseHeader>'''
+
+session = '''
+<readingSession>
+  <servicingRadiologistID>reader</servicingRadiologistID>
+  <unblindedReadNodule>
+    <noduleID>Nodule 001</noduleID>
+    <characteristics><malignancy>4</malignancy></characteristics>
+    <roi>
+      <imageZposition>-125.5</imageZposition>
+      <imageSOP_UID>1.2.3.4.1</imageSOP_UID>
+      <inclusion>TRUE</inclusion>
+      <edgeMap><xCoord>10</xCoord><yCoord>20</yCoord></edgeMap>
+      <edgeMap><xCoord>11</xCoord><yCoord>21</yCoord></edgeMap>
+      <edgeMap><xCoord>10</xCoord><yCoord>22</yCoord></edgeMap>
+    </roi>
+    <roi>
+      <imageZposition>-124.0</imageZposition>
+      <imageSOP_UID>1.2.3.4.2</imageSOP_UID>
+      <inclusion>TRUE</inclusion>
+      <edgeMap><xCoord>12</xCoord><yCoord>20</yCoord></edgeMap>
+    </roi>
+    <roi>
+      <imageZposition>-124.0</imageZposition>
+      <imageSOP_UID>1.2.3.4.2</imageSOP_UID>
+      <inclusion>FALSE</inclusion>
+      <edgeMap><xCoord>13</xCoord><yCoord>20</yCoord></edgeMap>
+    </roi>
+  </unblindedReadNodule>
+  <unblindedReadNodule>
+    <noduleID>IL057_127364</noduleID>
+    <roi>
+      <imageZposition>-124.0</imageZposition>
+      <imageSOP_UID>1.2.3.4.2</imageSOP_UID>
+      <inclusion>TRUE</inclusion>
+      <edgeMap><xCoord>30</xCoord><yCoord>40</yCoord></edgeMap>
+    </roi>
+  </unblindedReadNodule>
+</readingSession>'''
+
+message = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+          '<LidcReadMessage xmlns="http://www.nih.gov">{}</LidcReadMessage>'
+
+
+def slices(nodule):
+    return sorted((s.image_uid, s.z_pos, tuple(s.points))
+                  for s in nodule.slices)
+
+
+class AnnotationsTest(TestCase):
+    def assert_nodules(self, nodules):
+        self.assertEqual(sorted(nodules),
+                         [('1.2.3', '1.2.3.4', '1'),
+                          ('1.2.3', '1.2.3.4', 'IL057_127364')])
+
+        nodule = nodules[('1.2.3', '1.2.3.4', '1')]
+        self.assertEqual(nodule.study, '1.2.3')
+        self.assertEqual(nodule.series, '1.2.3.4')
+        # the excluded roi is skipped
+        self.assertEqual(slices(nodule),
+                         [('1.2.3.4.1', -125.5,
+                           ((10, 20), (11, 21), (10, 22))),
+                          ('1.2.3.4.2', -124.0, ((12, 20),))])
+        self.assertEqual(slices(nodules[('1.2.3', '1.2.3.4',
+                                         'IL057_127364')]),
+                         [('1.2.3.4.2', -124.0, ((30, 40),))])
+
+    def test_header_first(self):
+        self.assert_nodules(parse_nodules(
+            message.format(header + session), {}))
+
+    def test_header_after_session(self):
+        self.assert_nodules(parse_nodules(
+            message.format(session + header), {}))
+
+    def test_sessions_around_header(self):
+        # the same nodule of two readers has the slices of both
+        nodules = parse_nodules(message.format(
+            session + header + session.replace('-124.0', '-123.0')), {})
+        self.assertEqual(
+            [z for _, z, _ in slices(nodules[('1.2.3', '1.2.3.4', '1')])],
+            [-125.5, -124.0, -123.0])
+
+    def test_missing_header(self):
+        with self.assertRaises(ValueError):
+            parse_nodules(message.format(session), {})
+
+    def test_missing_session(self):
+        with self.assertRaises(ValueError):
+            parse_nodules(message.format(header), {})
+
+    def test_loader(self):
+        with TemporaryDirectory() as path:
+            with open(join(path, 'first.xml'), 'w') as f:
+                f.write(message.format(session + header))
+            with open(join(path, 'broken.xml'), 'w') as f:
+                f.write(message.format(session))
+
+            for _ in range(2):
+                # the second load reads the annotations cache
+                nodules = AnnotationsLoader(path).load_nodules_annotations()
+                self.assert_nodules({n.key: n for n in nodules})
+
+
+if __name__ == '__main__':
+    main()
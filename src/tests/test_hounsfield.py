@@ -0,0 +1,67 @@
+# coding=utf-8
+from io import BytesIO
+from struct import pack
+from unittest import TestCase
+from unittest import main
+
+from dicom import read_file
+from numpy import array
+from numpy import array_equal
+
+from benchmark.SyntheticDataset import ct_image_storage
+from benchmark.SyntheticDataset import data_element
+from benchmark.SyntheticDataset import explicit_little_endian
+from extract.Hounsfield import pixel_view
+
+
+def dicom_row(values, signed, bits_stored, high_bit=None):
+    # one row of 16 bit allocated pixels with the given stored bits
+    meta = b''.join([
+        data_element(0x0002, 0x0001, 'OB', b'\x00\x01'),
+        data_element(0x0002, 0x0002, 'UI', ct_image_storage),
+        data_element(0x0002, 0x0003, 'UI', '2.25.1'),
+        data_element(0x0002, 0x0010, 'UI', explicit_little_endian)])
+    elements = [
+        data_element(0x0028, 0x0002, 'US', pack('<H', 1)),
+        data_element(0x0028, 0x0004, 'CS', 'MONOCHROME2'),
+        data_element(0x0028, 0x0010, 'US', pack('<H', 1)),
+        data_element(0x0028, 0x0011, 'US', pack('<H', len(values))),
+        data_element(0x0028, 0x0100, 'US', pack('<H', 16)),
+        data_element(0x0028, 0x0101, 'US', pack('<H', bits_stored)),
+        data_element(0x0028, 0x0102, 'US',
+                     pack('<H', bits_stored - 1 if high_bit is None
+                          else high_bit)),
+        data_element(0x0028, 0x0103, 'US', pack('<H', signed)),
+        data_element(0x7FE0, 0x0010, 'OW',
+                     array(values, dtype='<u2').tobytes())]
+    return read_file(BytesIO(b''.join(
+        [b'\x00' * 128, b'DICM',
+         data_element(0x0002, 0x0000, 'UL', pack('<I', len(meta))),
+         meta] + elements)))
+
+
+class PixelViewTest(TestCase):
+    def assert_decoded(self, ds):
+        self.assertTrue(array_equal(pixel_view(ds), ds.pixel_array))
+
+    def test_signed_16_bits(self):
+        self.assert_decoded(dicom_row([0xFC18, 0xFFFF, 5, 100], 1, 16))
+
+    def test_unsigned_16_bits(self):
+        self.assert_decoded(dicom_row([0, 0xFFFF, 5, 100], 0, 16))
+
+    def test_signed_12_bits_are_sign_extended(self):
+        ds = dicom_row([3096, 4095, 5, 100], 1, 12)
+        self.assert_decoded(ds)
+        self.assertEqual(pixel_view(ds).tolist(), [[-1000, -1, 5, 100]])
+
+    def test_signed_12_bits_drop_unused_bits(self):
+        self.assert_decoded(dicom_row([0xF000 | 3096, 5, 0x8000 | 4095, 100],
+                                      1, 12))
+
+    def test_unsigned_12_bits_drop_unused_bits(self):
+        self.assert_decoded(dicom_row([0xF000 | 5, 0x1234, 4095, 7], 0, 12))
+
+
+if __name__ == '__main__':
+    main()
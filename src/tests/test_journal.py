@@ -0,0 +1,120 @@
+# coding=utf-8
+from collections import OrderedDict
+from os import remove
+from os.path import getsize
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+from unittest import main
+
+from Utils import file_signature
+from extract.DicomLoader import slice_image_name
+from extract.ExtractionJournal import ExtractionJournal
+from extract.ExtractionJournal import journal_file_name
+from extract.ImageExtractor import skip_completed
+from extract.Nodule import Nodule
+from extract.Slice import Slice
+
+settings = 'settings'
+malignancy = '3'
+
+
+def new_slice(z_pos):
+    # slices of every run get new random uids
+    return Slice('1.2.3.4.{}'.format(z_pos), z_pos,
+                 [(10, 10), (20, 10), (20, 20)])
+
+
+class JournalTest(TestCase):
+    def setUp(self):
+        self.output_path = mkdtemp(prefix='journal_test')
+        self.dicom_path = join(self.output_path, 'image.dcm')
+        self.write_dicom(b'pixels')
+        self.extract([1.0, 2.0])
+
+    def tearDown(self):
+        rmtree(self.output_path)
+
+    def write_dicom(self, data):
+        with open(self.dicom_path, 'wb') as f:
+            f.write(data)
+
+    def nodule(self):
+        nodule = Nodule('1.2.3', '1.2.3.4', '1')
+        nodule.malignancy = malignancy
+        return nodule
+
+    def extract(self, z_positions):
+        # journal of a run which has written the images of all slices
+        journal = ExtractionJournal(self.output_path, settings)
+        journal.open()
+        nodule = self.nodule()
+
+        for z_pos in z_positions:
+            nodule_slice = new_slice(z_pos)
+            open(slice_image_name(self.output_path, nodule, nodule_slice),
+                 'wb').close()
+            journal.record(nodule, nodule_slice,
+                           file_signature(self.dicom_path), None)
+
+        journal.close()
+
+    def resume(self, journal_settings=settings):
+        # slices left to extract and completed records of the next run
+        journal = ExtractionJournal(self.output_path, journal_settings)
+        journal.open()
+        nodule = self.nodule()
+        series_images = OrderedDict([
+            (('1.2.3', '1.2.3.4'), OrderedDict([
+                (self.dicom_path, [(nodule, new_slice(1.0)),
+                                   (nodule, new_slice(2.0))])]))])
+
+        try:
+            remaining, completed = skip_completed(series_images, journal,
+                                                  {}, self.output_path,
+                                                  False)
+        finally:
+            journal.close()
+
+        left = [s.z_pos for images in remaining.values()
+                for slices in images.values() for _, s in slices]
+        return left, sorted([r[3].z_pos for r in completed])
+
+    def test_completed(self):
+        self.assertEqual(self.resume(), ([], [1.0, 2.0]))
+
+    def test_changed_settings(self):
+        self.assertEqual(self.resume('other'), ([1.0, 2.0], []))
+        # the journal has been restarted
+        self.assertEqual(self.resume(), ([1.0, 2.0], []))
+
+    def test_changed_signature(self):
+        self.write_dicom(b'other pixels')
+        self.assertEqual(self.resume(), ([1.0, 2.0], []))
+
+    def test_missing_image(self):
+        journal = ExtractionJournal(self.output_path, settings)
+        journal.open()
+        record = journal.completed(self.nodule(), new_slice(2.0),
+                                   file_signature(self.dicom_path))
+        journal.close()
+        remove(slice_image_name(self.output_path, self.nodule(), record[3]))
+
+        self.assertEqual(self.resume(), ([2.0], [1.0]))
+
+    def test_truncated_journal(self):
+        journal_file = join(self.output_path, journal_file_name)
+
+        with open(journal_file, 'r+b') as f:
+            f.truncate(getsize(journal_file) - 10)
+
+        self.assertEqual(self.resume(), ([2.0], [1.0]))
+
+        # records appended after the truncation are read back
+        self.extract([2.0])
+        self.assertEqual(self.resume(), ([], [1.0, 2.0]))
+
+
+if __name__ == '__main__':
+    main()
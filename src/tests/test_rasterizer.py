@@ -0,0 +1,105 @@
+# coding=utf-8
+from unittest import TestCase
+from unittest import main
+
+from numpy import array
+from numpy import array_equal
+from numpy import mgrid
+from numpy import vstack
+from numpy.random import RandomState
+
+from benchmark.RasterizerBenchmark import random_contour
+from extract.Rasterizer import bounding_box
+from extract.Rasterizer import polygon_mask
+
+try:
+    from matplotlib.path import Path
+except ImportError:
+    Path = None
+
+margin = 2
+
+
+def box(xc, yc):
+    # pixels around the polygon, so its edges are inside the box
+    x_min, y_min, x_max, y_max = bounding_box(xc, yc)
+    return x_min - margin, y_min - margin, x_max + margin, y_max + margin
+
+
+def reference_mask(xc, yc, x_min, y_min, x_max, y_max):
+    y_grid, x_grid = mgrid[y_min:y_max, x_min:x_max]
+    points = vstack((x_grid.ravel(), y_grid.ravel())).T
+    path = Path(vstack((xc, yc)).T, closed=True)
+    return path.contains_points(points, radius=-1) \
+        .reshape(x_grid.shape)
+
+
+def closed(points):
+    points = list(points) + [points[0]]
+    return array([x for x, _ in points], dtype=float), \
+        array([y for _, y in points], dtype=float)
+
+
+class PolygonMaskTest(TestCase):
+    def setUp(self):
+        if Path is None:
+            self.skipTest('matplotlib is not installed')
+
+    def assert_matches(self, xc, yc):
+        bounds = box(xc, yc)
+        self.assertTrue(array_equal(polygon_mask(xc, yc, *bounds),
+                                    reference_mask(xc, yc, *bounds)),
+                        'mask differs for {}'.format(list(zip(xc, yc))))
+
+    def test_random_contours(self):
+        random = RandomState(0)
+
+        for _ in range(50):
+            self.assert_matches(*random_contour(random))
+
+    def test_random_polygons(self):
+        # few vertices anywhere, so edges cross each other
+        random = RandomState(1)
+
+        for _ in range(200):
+            count = random.randint(3, 9)
+            points = random.randint(100, 120, (count, 2))
+            self.assert_matches(*closed([tuple(p) for p in points]))
+
+    def test_both_orientations(self):
+        square = [(10, 10), (15, 10), (15, 15), (10, 15)]
+        self.assert_matches(*closed(square))
+        self.assert_matches(*closed(square[::-1]))
+
+    def test_collinear(self):
+        self.assert_matches(*closed([(10, 10), (12, 12), (14, 14)]))
+        self.assert_matches(*closed([(10, 10), (14, 10), (12, 10)]))
+
+    def test_single_pixel(self):
+        self.assert_matches(*closed([(10, 10)]))
+        self.assert_matches(*closed([(10, 10), (10, 10), (10, 10)]))
+
+    def test_two_pixels(self):
+        self.assert_matches(*closed([(10, 10), (11, 10)]))
+
+    def test_repeated_vertices(self):
+        self.assert_matches(*closed([(10, 10), (10, 10), (14, 10),
+                                     (14, 14), (14, 14), (10, 14)]))
+
+    def test_self_touching(self):
+        # two squares sharing one vertex
+        self.assert_matches(*closed([(10, 10), (14, 10), (14, 14),
+                                     (18, 14), (18, 18), (14, 18),
+                                     (14, 14), (10, 14)]))
+        # figure eight crossing itself
+        self.assert_matches(*closed([(10, 10), (16, 16), (16, 10),
+                                     (10, 16)]))
+
+    def test_empty_box(self):
+        xc, yc = closed([(10, 10), (14, 10), (14, 14)])
+        self.assertEqual(polygon_mask(xc, yc, 10, 10, 10, 14).shape,
+                         (4, 0))
+
+
+if __name__ == '__main__':
+    main()